@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Filename:    animation_benchmark.py
+Description: Benchmark and check the frame paths of create_animation in modules/plotter.py
+
+- synthetic global field with a time axis (no downloads needed)
+- renders the frames with each path: serial (full redraw), blit (cached
+  raster layers) and parallel (the PNG frames of one worker block)
+- checks that a frame from each path matches the serial frame (same size
+  and layout, colors within a small tolerance for the blended overlays)
+- prints the render time per frame of each path (without encoding)
+
+Exits with status 1 if a check fails.
+
+Usage:
+    python animation_benchmark.py
+    python animation_benchmark.py --nframes 40 --res 0.5
+
+"""
+import os, sys
+import argparse
+import io
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+
+
+def synthetic_dataset(nframes, res=1., seed=0):
+    """Dataset with a smooth global field 'z' that drifts in time"""
+    import pandas as pd
+    import xarray as xr
+
+    lats = np.arange(-90., 90. + res / 2, res)
+    lons = np.arange(-180., 180., res)
+    rng = np.random.default_rng(seed)
+    wave = np.sin(np.radians(lons))[None, :] * np.cos(np.radians(lats))[:, None]
+    noise = rng.standard_normal((nframes,) + wave.shape).cumsum(0) / 30.
+    ds = xr.Dataset({'z': (('time', 'lat', 'lon'), wave + noise,
+                           {'long_name': 'Synthetic field', 'units': 'm'})},
+                    coords={'time': pd.date_range('2000-01-01', periods=nframes, freq='6h')})
+
+    return ds, lats, lons
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nframes', type=int, default=20)
+    parser.add_argument('--res', type=float, default=1., help='grid spacing in degrees')
+    parser.add_argument('--frame', type=int, default=None,
+                        help='frame to compare (default: the middle one)')
+    parser.add_argument('--tolerance', type=int, default=3,
+                        help='largest color difference (0-255) allowed against the serial frame')
+    args = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.image as mpimg
+    import plotter
+
+    ds, lats, lons = synthetic_dataset(args.nframes, args.res)
+    clevs = np.linspace(-1.5, 1.5, 13)
+    cmap = 'RdBu_r'
+    k = args.nframes // 2 if args.frame is None else args.frame
+    da = ds['z']
+
+    def serial():
+        return plotter._serial_frames(ds, 'z', lats, lons, cmap, clevs)
+
+    def blit():
+        return plotter._blit_frames(ds, 'z', lats, lons, cmap, clevs)
+
+    def parallel():
+        # What one worker of _render_parallel renders for a block of frames
+        block = (da.values, ds.time.values, lats, lons, da.long_name, da.units,
+                 cmap, clevs, (12, 4))
+        for png in plotter._render_frames(block):
+            yield np.round(mpimg.imread(io.BytesIO(png), format='png') * 255).astype(np.uint8)
+
+    failed = []
+    frames = {}
+    print('{0:<9} {1:>11} {2:>10}'.format('path', 's / frame', 'max diff'))
+    for name, frames_of in (('serial', serial), ('blit', blit), ('parallel', parallel)):
+        t0 = time.time()
+        for i, frame in enumerate(frames_of()):
+            if i == k:
+                frames[name] = np.array(frame)
+        seconds = (time.time() - t0) / args.nframes
+        ref, frame = frames['serial'], frames[name]
+        if frame.shape != ref.shape:
+            failed.append('{0} frame is {1}, serial frame is {2}'.format(
+                name, frame.shape, ref.shape))
+            diff = np.nan
+        else:
+            diff = int(np.abs(frame.astype(int) - ref.astype(int)).max())
+            if diff > args.tolerance:
+                failed.append('{0} frame {1} differs from the serial frame by {2}'.format(
+                    name, k, diff))
+        print('{0:<9} {1:>11.3f} {2:>10}'.format(name, seconds, diff))
+
+    for msg in failed:
+        print('FAILED: ' + msg)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
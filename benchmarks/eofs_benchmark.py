@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Filename:    eofs_benchmark.py
+Description: Benchmark the solvers in modules/eofs.py across problem sizes
+
+- synthetic data with a known spectrum (no downloads needed)
+- sweeps n (observations), p (grid points), k (eofs) and dtype
+- records wall time, peak RSS and accuracy against the known spectrum
+- appends one JSON record per case to the output file
+
+Each case runs in a fresh process so the peak RSS belongs to that case.
+
+Usage:
+    python eofs_benchmark.py --n 500 2000 --p 2000 20000 --k 10 \
+        --dtype float32 float64 --output results.jsonl
+    python eofs_benchmark.py --compare old.jsonl results.jsonl
+
+"""
+import os, sys
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import time
+import multiprocessing as mp
+from queue import Empty
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+import eofs
+
+
+SOLVERS = ['calc_eofs', 'svd_full', 'svd_truncated', 'svd_randomized',
+           'calc_pcs', 'loadings']
+
+
+def synthetic_data(n, p, rank=50, decay=0.85, dtype='float64', seed=0):
+    """Data matrix z = U diag(s) V^T with orthonormal U, V and s_i = 100 decay^i
+    
+    Returns z [n x p], the singular values s and the singular vectors U, V.
+    """
+    rng = np.random.default_rng(seed)
+    rank = min(rank, n, p)
+    U, _ = np.linalg.qr(rng.standard_normal((n, rank)))
+    V, _ = np.linalg.qr(rng.standard_normal((p, rank)))
+    s = 100. * decay**np.arange(rank)
+    z = ((U * s) @ V.T).astype(dtype)
+    
+    return z, s, U, V
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB on Linux
+    if sys.platform == 'darwin':
+        return rss / 2.**20
+    return rss / 2.**10
+
+
+def _run_case(case, repeat, queue):
+    """Run one benchmark case and put its record on the queue."""
+    n, p, k, dtype, solver = (case[key] for key in ('n', 'p', 'k', 'dtype', 'solver'))
+    z, s, U, V = synthetic_data(n, p, dtype=dtype)
+    evals0 = s[0:k]**2 / (n - 1.)
+    evecs0 = V[:, 0:k]
+    data_rss = _peak_rss_mb()
+    
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        if solver == 'calc_eofs':
+            evals, evecs = eofs.calc_eofs(z)
+        elif solver.startswith('svd_'):
+            method = solver[4:]
+            evals, evecs, _, _ = eofs.calc_eofs_svd(z, k, method=method, random_state=0)
+        elif solver == 'calc_pcs':
+            pcs = eofs.calc_pcs(z, V.astype(dtype), k)
+        elif solver == 'loadings':
+            L = eofs.loadings(s**2 / (n - 1.), V.astype(dtype), k)
+        times.append(time.perf_counter() - t0)
+        
+    # Accuracy against the known spectrum
+    if solver == 'calc_pcs':
+        ref = (U[:, 0:k] * s[0:k]).T
+        err = {'relerr': float(np.abs(pcs - ref).max() / np.abs(ref).max())}
+    elif solver == 'loadings':
+        ref = V[:, 0:k] * s[0:k] / np.sqrt(n - 1.)
+        err = {'relerr': float(np.abs(L - ref).max() / np.abs(ref).max())}
+    else:
+        report = eofs._compare_modes(evals0, evecs0, evals[0:k].astype(float),
+                                     evecs[:, 0:k].astype(float))
+        err = {'evals_relerr': float(report['evals_relerr']),
+               'max_angle': float(report['max_angle'])}
+    
+    record = dict(case, repeat=repeat,
+                  time_min=min(times), time_median=float(np.median(times)),
+                  peak_rss_mb=_peak_rss_mb(), data_rss_mb=data_rss, **err)
+    queue.put(record)
+
+
+def _version_info():
+    """Code and environment versions recorded with every result."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                         cwd=here, stderr=subprocess.DEVNULL)
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'numpy': np.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'ncpu': os.cpu_count()}
+
+
+def _wait_record(proc, queue, timeout=None):
+    """Result of a case process, or None if it died or ran out of time."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1.)
+        except Empty:
+            pass
+        if not proc.is_alive():
+            # The record may have been sent just before the process exited
+            try:
+                return queue.get(timeout=1.)
+            except Empty:
+                return None
+        if deadline is not None and time.time() > deadline:
+            proc.terminate()
+            return None
+
+
+def run(ns, ps, ks, dtypes, solvers, repeat=3, full_limit=5000, output=None, timeout=None):
+    """Run every combination of the parameters and return the records.
+    
+    A case whose process fails (exception, out of memory, crash) or runs
+    longer than `timeout` seconds is recorded with status 'failed' and the
+    sweep continues.
+    """
+    ctx = mp.get_context('spawn')
+    info = _version_info()
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    records = []
+    
+    for n in ns:
+        for p in ps:
+            for k in ks:
+                for dtype in dtypes:
+                    for solver in solvers:
+                        # skip dense solvers that would not fit in memory
+                        if solver in ('calc_eofs', 'svd_full') and min(n, p) > full_limit:
+                            continue
+                        if k > min(n, p):
+                            continue
+                        case = {'n': n, 'p': p, 'k': k, 'dtype': dtype, 'solver': solver}
+                        queue = ctx.Queue()
+                        proc = ctx.Process(target=_run_case, args=(case, repeat, queue))
+                        proc.start()
+                        record = _wait_record(proc, queue, timeout)
+                        proc.join()
+                        if record is None:
+                            record = dict(case, status='failed', exitcode=proc.exitcode)
+                        else:
+                            record['status'] = 'ok'
+                        record.update(info, timestamp=stamp)
+                        records.append(record)
+                        print_record(record)
+                        if output is not None:
+                            with open(output, 'a') as f:
+                                f.write(json.dumps(record) + '\n')
+                                
+    return records
+
+
+def print_record(r):
+    if r.get('status') == 'failed':
+        print('{solver:>15s} n={n:<7d} p={p:<8d} k={k:<4d} {dtype:>8s} '
+              'FAILED (exit code {exitcode})'.format(**r))
+        return
+    err = r.get('max_angle', r.get('relerr'))
+    print('{solver:>15s} n={n:<7d} p={p:<8d} k={k:<4d} {dtype:>8s} '
+          '{time_min:9.4f} s {peak_rss_mb:9.1f} MB  err={err:.2e}'.format(err=err, **r))
+
+
+def compare(base_file, new_file):
+    """Print the time and memory ratio new/base for cases present in both files."""
+    def load(path):
+        out = {}
+        with open(path) as f:
+            for line in f:
+                r = json.loads(line)
+                if r.get('status') == 'failed':
+                    continue
+                out[(r['solver'], r['n'], r['p'], r['k'], r['dtype'])] = r
+        return out
+    
+    base = load(base_file)
+    new = load(new_file)
+    print('{:>15s} {:>7s} {:>8s} {:>4s} {:>8s} {:>8s} {:>8s}'.format(
+        'solver', 'n', 'p', 'k', 'dtype', 'time', 'rss'))
+    for key in sorted(set(base) & set(new)):
+        b, r = base[key], new[key]
+        print('{:>15s} {:7d} {:8d} {:4d} {:>8s} {:7.2f}x {:7.2f}x'.format(
+            *key, r['time_min'] / b['time_min'], r['peak_rss_mb'] / b['peak_rss_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, nargs='+', default=[500, 2000])
+    parser.add_argument('--p', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--k', type=int, nargs='+', default=[10])
+    parser.add_argument('--dtype', nargs='+', default=['float64'],
+                        choices=['float32', 'float64'])
+    parser.add_argument('--solvers', nargs='+', default=SOLVERS, choices=SOLVERS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--full-limit', type=int, default=5000,
+                        help='skip calc_eofs/svd_full when min(n, p) exceeds this')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds after which a case is stopped and recorded as failed')
+    parser.add_argument('--output', default='eofs_benchmark.jsonl')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args()
+    
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args.n, args.p, args.k, args.dtype, args.solvers, repeat=args.repeat,
+            full_limit=args.full_limit, output=args.output, timeout=args.timeout)
+
+
+if __name__ == '__main__':
+    main()
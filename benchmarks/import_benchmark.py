@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Filename:    import_benchmark.py
+Description: Measure the import (startup) time of the pyclivac modules
+
+- imports each module in a fresh interpreter, several times
+- reports the median and best wall time of the import
+- lists the heavy optional packages the import pulled in
+- lists the slowest imports (python -X importtime, cumulative)
+- exits with status 1 if a module is over its time budget
+
+The budget guards against new module-level imports of heavy packages
+(cartopy, seaborn, xarray, pandas, pyplot, ...): these belong inside the
+functions that use them.
+
+Usage:
+    python import_benchmark.py
+    python import_benchmark.py --modules plotter --repeat 10 --budget 0.5
+    python import_benchmark.py --top 15
+
+"""
+import os, sys
+import argparse
+import json
+import subprocess
+
+import numpy as np
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules')
+
+# Default import budget in seconds (numpy and matplotlib core are allowed)
+BUDGETS = {'eofs': 0.3, 'plotter': 0.6}
+
+HEAVY = ['cartopy', 'seaborn', 'xarray', 'pandas', 'netCDF4', 'dask', 'scipy',
+         'matplotlib.pyplot', 'matplotlib.animation']
+
+_TIMER = """
+import sys, time, json
+sys.path.insert(0, {path!r})
+t0 = time.perf_counter()
+import {module}
+t = time.perf_counter() - t0
+print(json.dumps({{'seconds': t, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def time_import(module, repeat=5):
+    """Import `module` in `repeat` fresh interpreters.
+
+    Returns the list of import times in seconds and the heavy packages
+    loaded by the import.
+    """
+    code = _TIMER.format(path=MODULES_DIR, module=module, heavy=HEAVY)
+    times = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], check=True,
+                             capture_output=True, text=True).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        times.append(r['seconds'])
+
+    return times, r['loaded']
+
+
+def slowest_imports(module, top=10):
+    """Slowest imports below `module` (cumulative microseconds) from -X importtime."""
+    code = 'import sys; sys.path.insert(0, {0!r}); import {1}'.format(MODULES_DIR, module)
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], check=True,
+                         capture_output=True, text=True).stderr
+    entries = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        # one space, then two more per nesting level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((depth, int(cum_us), name.strip()))
+
+    # -X importtime lists the imports of a module before the module itself:
+    # find the line of `module`, then go back over the entries nested
+    # directly under it until the previous top level import
+    end = max(i for i, (depth, _, name) in enumerate(entries)
+              if depth == 0 and name == module)
+    rows = []
+    for depth, cum_us, name in reversed(entries[:end]):
+        if depth == 0:
+            break
+        if depth == 1:
+            rows.append((cum_us, name))
+
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=sorted(BUDGETS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=None,
+                        help='import budget in seconds for every module (default: per module)')
+    parser.add_argument('--top', type=int, default=8,
+                        help='number of slowest imports to list')
+    args = parser.parse_args()
+
+    over = []
+    for module in args.modules:
+        times, loaded = time_import(module, args.repeat)
+        budget = args.budget if args.budget is not None else BUDGETS.get(module, 0.5)
+        median = np.median(times)
+        status = 'ok' if median <= budget else 'OVER BUDGET'
+        print('{0:<10} median {1:6.3f} s  best {2:6.3f} s  budget {3:5.2f} s  {4}'.format(
+            module, median, min(times), budget, status))
+        print('           heavy packages loaded: {0}'.format(', '.join(loaded) or 'none'))
+        for cum_us, name in slowest_imports(module, args.top):
+            print('           {0:8.3f} s  {1}'.format(cum_us / 1e6, name))
+        if median > budget:
+            over.append(module)
+
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
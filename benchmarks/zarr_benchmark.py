@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Filename:    zarr_benchmark.py
+Description: Benchmark and check downloads/ERA5/era5_to_zarr.py
+
+- writes synthetic yearly NetCDF files packed to 16 bits like the CDS
+  files, each year with its own range (scale factor and offset)
+- appends them to a Zarr store in each layout and times the appends,
+  reading a point time series and reading one map
+- checks that the values read back match the source files, and that
+  packed stores (--packed) refuse files packed with another range
+  instead of clipping them
+
+Exits with status 1 if a check fails.
+
+Usage:
+    python zarr_benchmark.py
+    python zarr_benchmark.py --years 4 --ntimes 1460 --shape 181 360
+
+"""
+import os, sys
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'downloads', 'ERA5'))
+
+
+def write_year(path, year, ntimes, shape, seed=0):
+    """Packed NetCDF file of one year; each year has a different range
+
+    Returns the unpacked values written to the file.
+    """
+    import pandas as pd
+    import xarray as xr
+
+    rng = np.random.default_rng(seed + year)
+    # e.g. z500 in m: a narrow range one year, a wide range the next
+    lo, hi = (4946., 5050.) if year % 2 == 0 else (4563., 5484.)
+    values = rng.uniform(lo, hi, (ntimes,) + tuple(shape))
+    scale = (hi - lo) / 65532.
+    offset = (hi + lo) / 2.
+    ds = xr.Dataset({'z': (('time', 'latitude', 'longitude'), values)},
+                    coords={'time': pd.date_range('{0}-01-01'.format(year), periods=ntimes,
+                                                  freq='6h'),
+                            'latitude': np.linspace(90, -90, shape[0]),
+                            'longitude': np.linspace(0, 360, shape[1], endpoint=False)})
+    ds.to_netcdf(path, encoding={'z': {'dtype': 'int16', 'scale_factor': scale,
+                                       'add_offset': offset, '_FillValue': -32767}})
+
+    # Values as stored in the file (after packing)
+    return np.round((values - offset) / scale) * scale + offset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--ntimes', type=int, default=120, help='time steps per year')
+    parser.add_argument('--shape', type=int, nargs=2, default=[91, 180], metavar=('NLAT', 'NLON'))
+    args = parser.parse_args()
+
+    import warnings
+    import era5_to_zarr as ez
+    warnings.simplefilter('ignore')
+
+    tmp = tempfile.mkdtemp()
+    failed = []
+    try:
+        files, values = [], []
+        for year in range(2000, 2000 + args.years):
+            path = os.path.join(tmp, 'era5_z_{0}.nc'.format(year))
+            values.append(write_year(path, year, args.ntimes, args.shape))
+            files.append(path)
+        values = np.concatenate(values)
+
+        print('{0:<6} {1:>9} {2:>10} {3:>9} {4:>10}'.format(
+            'layout', 'append s', 'series s', 'map s', 'max err'))
+        for layout in ('time', 'map'):
+            store = os.path.join(tmp, layout + '.zarr')
+            t0 = time.time()
+            ez.append_to_zarr(files, store, layout=layout, log=lambda msg: None)
+            t_append = time.time() - t0
+            ds = ez.open_store(store)
+            t0 = time.time()
+            ds.z[:, args.shape[0] // 2, args.shape[1] // 2].values
+            t_series = time.time() - t0
+            t0 = time.time()
+            ds.z[-1].values
+            t_map = time.time() - t0
+            err = float(np.abs(ds.z.values - values).max())
+            print('{0:<6} {1:>9.2f} {2:>10.3f} {3:>9.3f} {4:>10.4f}'.format(
+                layout, t_append, t_series, t_map, err))
+            # float32 keeps about 7 digits of the ~5000 m values
+            if err > 1e-3 * np.abs(values).max():
+                failed.append('{0} layout: values differ from the files by {1:.3g}'.format(
+                    layout, err))
+
+        if args.years > 1:
+            store = os.path.join(tmp, 'packed.zarr')
+            try:
+                ez.append_to_zarr(files[0:2], store, float32=False, log=lambda msg: None)
+                failed.append('packed store accepted files packed with different ranges')
+            except ValueError:
+                print('packed: files packed with different ranges refused')
+    finally:
+        shutil.rmtree(tmp)
+
+    for msg in failed:
+        print('FAILED: ' + msg)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""
+Filename:    prepERA5-WRF.py
+Description: Download the ERA5 data for one WRF case (model level,
+             pressure level and surface) in one run
+
+- builds the model level, pressure level and surface requests of
+  getERA5-WRF-ml.py, getERA5-WRF-pl.py and getERA5-WRF-sfc.py from one
+  case definition (dates, interval, domain)
+- prints the plan, then submits the requests concurrently with one CDS
+  client (retries, resume and atomic writes as in ../era5_download.py)
+- writes the GRIB files, a namelist.wps &share fragment and a timing
+  summary to one case directory, ready for link_grib.csh and ungrib.exe
+- checks that every downloaded file covers the times and area of the case
+  (needs cfgrib) and reports the files that do not
+
+Usage:
+    conda activate cds
+    python prepERA5-WRF.py --start 20180706 --end 20180707 --interval 3 \
+        --area 60 -150 10 -100 --outdir /home/sbarc/students/montini/data/downloads
+    python prepERA5-WRF.py --start 20180706 --end 20180707 --levels pl sfc --dry-run
+
+"""
+import os, sys
+import argparse
+import datetime
+import json
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import era5_download as dl
+import era5_plan
+from era5_catalog import Catalog, request_metadata
+
+
+# Model level (ml) and surface (sfc) parameters, as in getERA5-WRF-ml.py / -sfc.py
+ML_PARAMS = '129/130/131/132/133/152'
+SFC_PARAMS = ('msl/sp/skt/2t/10u/10v/2d/z/lsm/sst/ci/sd/'
+              'stl1/stl2/stl3/stl4/swvl1/swvl2/swvl3/swvl4')
+
+# Pressure level (pl) variables and levels, as in getERA5-WRF-pl.py
+PL_VARIABLES = ['geopotential', 'relative_humidity', 'specific_humidity',
+                'temperature', 'u_component_of_wind', 'v_component_of_wind']
+PL_LEVELS = ['1', '2', '3', '5', '7', '10', '20', '30', '50', '70', '100', '125',
+             '150', '175', '200', '225', '250', '300', '350', '400', '450', '500',
+             '550', '600', '650', '700', '750', '775', '800', '825', '850', '875',
+             '900', '925', '950', '975', '1000']
+
+
+def case_jobs(start, end, interval, area, grid, casedir, levels=('ml', 'pl', 'sfc')):
+    """Download jobs of a WRF case
+
+    Parameters
+    ----------
+    start, end : str
+        first and last day, YYYYMMDD
+    interval : int
+        hours between analyses (must divide 24)
+    area : list
+        [N, W, S, E]
+    grid : float
+        grid spacing in degrees
+    casedir : str
+        output directory
+    levels : list of str, optional
+        data to download: 'ml' (model levels), 'pl' (pressure levels),
+        'sfc' (surface). Default: all three
+
+    Returns
+    -------
+    jobs : dict
+        download job (see era5_download.split_jobs) for each of levels
+
+    """
+    if 24 % interval != 0:
+        raise ValueError("interval must divide 24 hours")
+    north, west, south, east = area
+    mars = {'class': 'ea', 'expver': '1', 'stream': 'oper', 'type': 'an',
+            'date': '{0}/to/{1}'.format(start, end),
+            'time': '00/to/{0:02d}/by/{1}'.format(24 - interval, interval),
+            'area': '{0}/{1}/{2}/{3}'.format(north, west, south, east),
+            'grid': '{0}/{0}'.format(grid),
+            'format': 'grib'}
+    requests = {
+        'ml': ('reanalysis-era5-complete',
+               dict(mars, param=ML_PARAMS, levtype='ml', levelist='1/to/137')),
+        'pl': ('reanalysis-era5-pressure-levels',
+               {'product_type': 'reanalysis',
+                'pressure_level': PL_LEVELS,
+                'variable': PL_VARIABLES,
+                'date': '{0:%Y-%m-%d}/{1:%Y-%m-%d}'.format(_day(start), _day(end)),
+                'time': ['{0:02d}:00'.format(h) for h in range(0, 24, interval)],
+                'area': [north, west, south, east],
+                'grid': [grid, grid],
+                'format': 'grib'}),
+        'sfc': ('reanalysis-era5-complete',
+                dict(mars, param=SFC_PARAMS, levtype='sfc')),
+    }
+
+    jobs = {}
+    for lev in levels:
+        dataset, request = requests[lev]
+        target = os.path.join(casedir, 'ERA5_{0}_{1}_{2}.grib'.format(lev, start, end))
+        jobs[lev] = {'dataset': dataset, 'request': request, 'target': target}
+
+    return jobs
+
+
+def _day(yyyymmdd):
+    return datetime.datetime.strptime(str(yyyymmdd), '%Y%m%d')
+
+
+def case_metadata(jobs):
+    """Times, area and grid of a case (see era5_catalog.request_metadata)"""
+    job = next(iter(jobs.values()))
+    return request_metadata(job['dataset'], job['request'])
+
+
+def _coverage_problems(lev, times, lats, lons, meta):
+    """Differences between the times/area of a downloaded file and the case"""
+    problems = []
+    start = np.datetime64(meta['start'])
+    expected = start + np.arange(meta['ntimes']) * np.timedelta64(int(meta['step'] * 3600), 's')
+    times = np.unique(np.asarray(times, dtype='datetime64[s]'))
+    if not np.array_equal(times, expected.astype('datetime64[s]')):
+        problems.append("{0}: {1} times from {2} to {3}, expected {4} from {5} to {6}".format(
+            lev, len(times), times[0] if len(times) else None,
+            times[-1] if len(times) else None, len(expected), expected[0], expected[-1]))
+    north, west, south, east = meta['area']
+    tol = 0.5 * max(meta['grid'])
+    # GRIB longitudes may run 0-360
+    def lon_diff(a, b):
+        return abs((a - b + 180.) % 360. - 180.)
+    if (abs(np.max(lats) - north) > tol or abs(np.min(lats) - south) > tol
+            or lon_diff(np.min(lons), west) > tol or lon_diff(np.max(lons), east) > tol):
+        problems.append("{0}: area {1:g}/{2:g}/{3:g}/{4:g}, expected {5:g}/{6:g}/{7:g}/{8:g}".format(
+            lev, np.max(lats), np.min(lons), np.min(lats), np.max(lons),
+            north, west, south, east))
+
+    return problems
+
+
+def check_files(jobs, meta):
+    """Check that the downloaded GRIB files cover the times and area of the case
+
+    Needs cfgrib; without it only the GRIB structure is checked. Every
+    field of a file is read (cfgrib.open_datasets), since model level and
+    surface files mix several level types.
+
+    Returns
+    -------
+    problems : list of str
+        one message per file that is incomplete or covers other times or
+        another area than the case
+
+    """
+    problems = []
+    for lev, job in jobs.items():
+        if not dl.verify_file(job['target'], 'grib'):
+            problems.append("{0}: {1} is not a complete GRIB file".format(lev, job['target']))
+    if problems:
+        return problems
+    try:
+        import cfgrib
+    except ImportError:
+        print("cfgrib not installed: skipped the check of times and area in the GRIB files")
+        return problems
+
+    for lev, job in jobs.items():
+        try:
+            datasets = cfgrib.open_datasets(job['target'], indexpath='')
+            times = np.concatenate([ds['valid_time'].values.ravel() for ds in datasets])
+            lats = np.concatenate([ds['latitude'].values.ravel() for ds in datasets])
+            lons = np.concatenate([ds['longitude'].values.ravel() for ds in datasets])
+            for ds in datasets:
+                ds.close()
+        except Exception as err:
+            problems.append("{0}: could not read {1}: {2}".format(lev, job['target'], err))
+            continue
+        problems.extend(_coverage_problems(lev, times, lats, lons, meta))
+
+    return problems
+
+
+def write_namelist(casedir, meta, interval):
+    """Write the &share times of namelist.wps for the case"""
+    start = datetime.datetime.strptime(meta['start'], '%Y-%m-%dT%H:%M:%S')
+    end = datetime.datetime.strptime(meta['end'], '%Y-%m-%dT%H:%M:%S')
+    path = os.path.join(casedir, 'namelist.wps.share')
+    with open(path, 'w') as f:
+        f.write("&share\n")
+        f.write(" start_date = '{0:%Y-%m-%d_%H:%M:%S}',\n".format(start))
+        f.write(" end_date   = '{0:%Y-%m-%d_%H:%M:%S}',\n".format(end))
+        f.write(" interval_seconds = {0},\n".format(interval * 3600))
+        f.write("/\n")
+
+    return path
+
+
+def print_timing(jobs, results, elapsed):
+    """Print (and return) the time of each download and of the whole case"""
+    print('{0:<5} {1:>9} {2:>9} {3:>9}  {4}'.format('data', 'status', 'attempts', 'seconds', 'file'))
+    for (lev, job), r in zip(jobs.items(), results):
+        print('{0:<5} {1:>9} {2:>9} {3:>9.1f}  {4}'.format(
+            lev, r['status'], r['attempts'], r.get('seconds', 0.), job['target']))
+    total = sum(r.get('seconds', 0.) for r in results)
+    print('elapsed {0:.1f} s (sum of downloads {1:.1f} s)'.format(elapsed, total))
+
+    return {'elapsed': elapsed,
+            'downloads': {lev: r for lev, r in zip(jobs, results)}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--start', required=True, help='first day, YYYYMMDD')
+    parser.add_argument('--end', required=True, help='last day, YYYYMMDD')
+    parser.add_argument('--interval', type=int, default=3, help='hours between analyses')
+    parser.add_argument('--area', type=float, nargs=4, default=[60, -150, 10, -100],
+                        metavar=('N', 'W', 'S', 'E'))
+    parser.add_argument('--grid', type=float, default=0.25)
+    parser.add_argument('--levels', nargs='+', default=['ml', 'pl', 'sfc'],
+                        choices=['ml', 'pl', 'sfc'])
+    parser.add_argument('--outdir', default='.')
+    parser.add_argument('--case', default=None,
+                        help='case directory name (default: ERA5_<start>_<end>)')
+    parser.add_argument('--catalog', default=None, help='SQLite catalog of downloads')
+    parser.add_argument('--dry-run', action='store_true', help='only print the plan')
+    parser.add_argument('--fake', action='store_true',
+                        help='use era5_download.FakeClient instead of the CDS')
+    args = parser.parse_args()
+
+    casedir = os.path.join(args.outdir, args.case or 'ERA5_{0}_{1}'.format(args.start, args.end))
+    jobs = case_jobs(args.start, args.end, args.interval, args.area, args.grid, casedir,
+                     args.levels)
+    meta = case_metadata(jobs)
+    print("Case {0}: {1} to {2} every {3} h, area {4}, grid {5}".format(
+        casedir, meta['start'], meta['end'], args.interval, meta['area'], meta['grid']))
+    era5_plan.print_plan(list(jobs.values()))
+    if args.dry_run:
+        return
+
+    # Submit all requests at once and wait for them together
+    client = dl.FakeClient() if args.fake else None
+    catalog = Catalog(args.catalog) if args.catalog else None
+    t0 = time.time()
+    results = dl.download_jobs(list(jobs.values()), client=client, max_inflight=len(jobs),
+                               catalog=catalog)
+    elapsed = time.time() - t0
+    timing = print_timing(jobs, results, elapsed)
+    if any(r['status'] == 'failed' for r in results):
+        sys.exit(1)
+    # Duplicates of an earlier download: link them into the case directory
+    os.makedirs(casedir, exist_ok=True)
+    for job, r in zip(jobs.values(), results):
+        if r['status'] == 'duplicate' and not os.path.lexists(job['target']):
+            os.symlink(os.path.abspath(r['path']), job['target'])
+
+    problems = [] if args.fake else check_files(jobs, meta)
+    timing['problems'] = problems
+    namelist = write_namelist(casedir, meta, args.interval)
+    with open(os.path.join(casedir, 'timing.json'), 'w') as f:
+        json.dump(timing, f, indent=2)
+    if problems:
+        print("Check the downloads before running ungrib:")
+        for msg in problems:
+            print("  " + msg)
+    else:
+        print("Ready for ungrib: {0}".format(casedir))
+    print("  {0} (times for namelist.wps)".format(namelist))
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
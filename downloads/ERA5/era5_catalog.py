@@ -0,0 +1,369 @@
+"""
+Filename:    era5_catalog.py
+Description: Local catalog (SQLite index) of downloaded ERA5 files
+
+- records the request, variables, levels, time coverage, area, grid,
+  size and checksum of each downloaded file
+- finds the files that hold a variable/level over a time range and area,
+  e.g. "z500 6-hourly 1979-2016 over this box", without opening any file
+- lets era5_download skip requests that were already downloaded, even
+  to a different file name
+- indexes files downloaded before the catalog existed (NetCDF metadata
+  is read with netCDF4)
+
+Example:
+    from era5_catalog import Catalog
+    cat = Catalog('/data/era5_catalog.sqlite')
+    era5_download.download_jobs(jobs, catalog=cat)   # records each download
+    cat.scan('/data/downloads/z500')                 # index existing files
+    files = cat.find(variable='z', level=500, start='1979-01-01', end='2016-12-31',
+                     step=6, area=[50, -130, 20, -60])
+    ds = xr.open_mfdataset(files)
+    cat.to_dataframe().to_parquet('catalog.parquet')
+
+"""
+import os
+import glob
+import hashlib
+import json
+import sqlite3
+import datetime
+
+import era5_plan
+
+
+# CDS variable names and the short names used in the data files
+SHORT_NAMES = {'geopotential': 'z', 'temperature': 't', 'specific_humidity': 'q',
+               'relative_humidity': 'r', 'u_component_of_wind': 'u',
+               'v_component_of_wind': 'v', 'vorticity': 'vo', 'vertical_velocity': 'w',
+               'surface_pressure': 'sp', 'mean_sea_level_pressure': 'msl',
+               'total_precipitation': 'tp', 'orography': 'orog',
+               'vertical_integral_of_eastward_water_vapour_flux': 'p71.162',
+               'vertical_integral_of_northward_water_vapour_flux': 'p72.162',
+               # MARS parameter ids (reanalysis-era5-complete)
+               '129': 'z', '130': 't', '131': 'u', '132': 'v', '133': 'q', '152': 'lnsp'}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dataset TEXT,
+    request TEXT,
+    request_key TEXT,
+    start TEXT,
+    end TEXT,
+    ntimes INTEGER,
+    step REAL,
+    north REAL, west REAL, south REAL, east REAL,
+    dx REAL, dy REAL,
+    format TEXT,
+    size INTEGER,
+    mtime REAL,
+    checksum TEXT,
+    added TEXT
+);
+CREATE TABLE IF NOT EXISTS fields (
+    path TEXT REFERENCES files(path) ON DELETE CASCADE,
+    variable TEXT,
+    short_name TEXT,
+    level REAL
+);
+CREATE INDEX IF NOT EXISTS fields_name ON fields (short_name, level);
+CREATE INDEX IF NOT EXISTS fields_variable ON fields (variable, level);
+CREATE INDEX IF NOT EXISTS files_request ON files (request_key);
+CREATE INDEX IF NOT EXISTS files_time ON files (start, end);
+"""
+
+
+def request_key(dataset, request):
+    """Checksum identifying a request (independent of key order and output file)"""
+    text = json.dumps([dataset, request], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def checksum(path, blocksize=2**20):
+    """sha256 of a file, read in blocks"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _file_format(path):
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    if head.startswith(b'GRIB'):
+        return 'grib'
+    if head.startswith(b'CDF') or head.startswith(b'\x89HDF'):
+        return 'netcdf'
+    return None
+
+
+def request_metadata(dataset, request):
+    """Variables, levels, time coverage, area and grid of a CDS request
+
+    Returns
+    -------
+    meta : dict
+        'variables' (list), 'levels' (list, [None] for single level data),
+        'start' and 'end' (ISO date-time), 'ntimes', 'step' (hours between
+        time steps, None if irregular), 'area' [N, W, S, E] and 'grid' [dx, dy]
+
+    """
+    dates = era5_plan.expand_dates(dataset, request)
+    hours = sorted(era5_plan.expand_ints(request.get('time', '00:00'), hours=True))
+    times = [datetime.datetime(d.year, d.month, d.day, h) for d in dates for h in hours]
+    steps = set(b - a for a, b in zip(times[:-1], times[1:]))
+    step = steps.pop().total_seconds() / 3600. if len(steps) == 1 else None
+
+    return {'variables': era5_plan.request_values(request.get('variable',
+                                                              request.get('param', ''))),
+            'levels': era5_plan.request_levels(request),
+            'start': times[0].isoformat() if times else None,
+            'end': times[-1].isoformat() if times else None,
+            'ntimes': len(times), 'step': step,
+            'area': era5_plan.request_area(request),
+            'grid': era5_plan.request_grid(request)}
+
+
+def file_metadata(path):
+    """Variables, levels, time coverage, area and grid read from a NetCDF file
+
+    Returns a dict like `request_metadata` (variables are the short names
+    in the file).
+    """
+    import netCDF4 as nc
+
+    with nc.Dataset(path) as ds:
+        names = ds.variables
+        tname = next(n for n in ('time', 'valid_time') if n in names)
+        latname = next(n for n in ('latitude', 'lat') if n in names)
+        lonname = next(n for n in ('longitude', 'lon') if n in names)
+        levname = next((n for n in ('level', 'pressure_level', 'plev') if n in names), None)
+        coords = {tname, latname, lonname, levname}
+        tvar = ds.variables[tname]
+        times = nc.num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard'),
+                            only_use_cftime_datetimes=False)
+        lats = ds.variables[latname][:]
+        lons = ds.variables[lonname][:]
+        variables = [n for n, v in ds.variables.items()
+                     if n not in coords and tname in v.dimensions]
+        levels = [float(l) for l in ds.variables[levname][:]] if levname else [None]
+
+    steps = set(b - a for a, b in zip(times[:-1], times[1:]))
+    return {'variables': variables, 'levels': levels,
+            'start': times[0].isoformat(), 'end': times[-1].isoformat(),
+            'ntimes': len(times),
+            'step': steps.pop().total_seconds() / 3600. if len(steps) == 1 else None,
+            'area': [float(lats.max()), float(lons.min()), float(lats.min()), float(lons.max())],
+            'grid': [float(abs(lons[1] - lons[0])) if len(lons) > 1 else None,
+                     float(abs(lats[1] - lats[0])) if len(lats) > 1 else None]}
+
+
+class Catalog(object):
+    """SQLite index of downloaded ERA5 files
+
+    Parameters
+    ----------
+    path : str, optional
+        database file, created if missing. Default: 'era5_catalog.sqlite'
+
+    Notes
+    -----
+    A Catalog (like its sqlite3 connection) must be used from the thread
+    that created it; era5_download.download_jobs only uses it from the
+    calling thread.
+
+    """
+    def __init__(self, path='era5_catalog.sqlite'):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def add(self, path, dataset=None, request=None, meta=None):
+        """Add (or update) a file
+
+        Metadata come from the request if given, else from `meta`, else from
+        the file itself (NetCDF only). The checksum is only recomputed when
+        the size or modification time of the file changed.
+
+        Parameters
+        ----------
+        path : str
+            downloaded file
+        dataset : str, optional
+            CDS dataset name
+        request : dict, optional
+            CDS request the file was downloaded with
+        meta : dict, optional
+            metadata as returned by `request_metadata`
+
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        old = self.db.execute('SELECT size, mtime, checksum FROM files WHERE path = ?',
+                              (path,)).fetchone()
+        if old is not None and old[0] == stat.st_size and old[1] == stat.st_mtime:
+            digest = old[2]
+        else:
+            digest = checksum(path)
+        fmt = _file_format(path)
+        if meta is None:
+            if request is not None:
+                meta = request_metadata(dataset, request)
+            elif fmt == 'netcdf':
+                meta = file_metadata(path)
+            else:
+                meta = {'variables': [], 'levels': [None], 'start': None, 'end': None,
+                        'ntimes': None, 'step': None, 'area': [None]*4, 'grid': [None]*2}
+
+        with self.db:
+            self.db.execute('DELETE FROM fields WHERE path = ?', (path,))
+            self.db.execute('INSERT OR REPLACE INTO files VALUES '
+                            '(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                            (path, dataset,
+                             json.dumps(request, sort_keys=True) if request else None,
+                             request_key(dataset, request) if request else None,
+                             meta['start'], meta['end'], meta['ntimes'], meta['step'],
+                             meta['area'][0], meta['area'][1], meta['area'][2], meta['area'][3],
+                             meta['grid'][0], meta['grid'][1], fmt,
+                             stat.st_size, stat.st_mtime, digest,
+                             datetime.datetime.now().isoformat(timespec='seconds')))
+            self.db.executemany('INSERT INTO fields VALUES (?,?,?,?)',
+                                [(path, var, SHORT_NAMES.get(var, var), lev)
+                                 for var in meta['variables'] for lev in meta['levels']])
+
+    def add_job(self, job):
+        """Add the target of a download job (see era5_download.split_jobs)"""
+        self.add(job['target'], job['dataset'], job['request'])
+
+    def lookup(self, dataset, request, verify=True):
+        """Path of a file already downloaded with the same request, or None
+
+        With verify, the file must still exist with its recorded size.
+        """
+        rows = self.db.execute('SELECT path, size FROM files WHERE request_key = ?',
+                               (request_key(dataset, request),)).fetchall()
+        for path, size in rows:
+            if not verify or (os.path.exists(path) and os.path.getsize(path) == size):
+                return path
+        return None
+
+    def find(self, variable=None, level=None, start=None, end=None, step=None,
+             area=None, dataset=None):
+        """Files holding a variable and level over a time range and area
+
+        Parameters
+        ----------
+        variable : str, optional
+            CDS name ('geopotential') or short name ('z')
+        level : float, optional
+            pressure or model level
+        start, end : str or datetime, optional
+            time range ('1979-01-01', '2016-12-31T18:00'); files that
+            overlap it are returned
+        step : float, optional
+            time step in hours (e.g. 6 for 6-hourly data)
+        area : list, optional
+            [N, W, S, E]; only files covering the whole box are returned
+        dataset : str, optional
+            CDS dataset name
+
+        Returns
+        -------
+        paths : list of str
+            matching files ordered by start time
+
+        """
+        query = ['SELECT DISTINCT files.path FROM files JOIN fields ON files.path = fields.path WHERE 1']
+        args = []
+        if variable is not None:
+            query.append('AND (fields.short_name = ? OR fields.variable = ?)')
+            args += [SHORT_NAMES.get(variable, variable), variable]
+        if level is not None:
+            query.append('AND fields.level = ?')
+            args.append(float(level))
+        if start is not None:
+            query.append('AND files.end >= ?')
+            args.append(_isoformat(start))
+        if end is not None:
+            query.append('AND files.start <= ?')
+            args.append(_isoformat(end, end=True))
+        if step is not None:
+            query.append('AND files.step = ?')
+            args.append(float(step))
+        if area is not None:
+            north, west, south, east = area
+            query.append('AND files.north >= ? AND files.west <= ? '
+                         'AND files.south <= ? AND files.east >= ?')
+            args += [north, west, south, east]
+        if dataset is not None:
+            query.append('AND files.dataset = ?')
+            args.append(dataset)
+        query.append('ORDER BY files.start')
+
+        return [row[0] for row in self.db.execute(' '.join(query), args)]
+
+    def scan(self, directory, pattern='*.nc', log=print):
+        """Add the files in a directory that are not in the catalog yet
+
+        Returns the number of files added.
+        """
+        known = set(row[0] for row in self.db.execute('SELECT path FROM files'))
+        n = 0
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            path = os.path.abspath(path)
+            if path in known or path.endswith('.part'):
+                continue
+            try:
+                self.add(path)
+                n += 1
+            except Exception as err:
+                log("Could not index {0}: {1}".format(path, err))
+
+        return n
+
+    def verify(self, path):
+        """True if the file still matches its recorded checksum"""
+        path = os.path.abspath(path)
+        row = self.db.execute('SELECT checksum FROM files WHERE path = ?', (path,)).fetchone()
+        return row is not None and os.path.exists(path) and checksum(path) == row[0]
+
+    def remove(self, path):
+        with self.db:
+            self.db.execute('DELETE FROM files WHERE path = ?', (os.path.abspath(path),))
+
+    def to_dataframe(self):
+        """Catalog as a pandas DataFrame, one row per file and field
+
+        Use .to_parquet() on the result to export the catalog.
+        """
+        import pandas as pd
+
+        return pd.read_sql_query('SELECT files.*, fields.variable, fields.short_name, '
+                                 'fields.level FROM files JOIN fields '
+                                 'ON files.path = fields.path', self.db)
+
+
+def _isoformat(t, end=False):
+    """ISO string of a date or date-time; a date alone extends to the end of the day"""
+    if isinstance(t, (datetime.date, datetime.datetime)):
+        t = t.isoformat()
+    t = str(t)
+    if end and len(t) == 10:
+        t = t + 'T23:59:59'
+
+    return t
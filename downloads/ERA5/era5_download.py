@@ -0,0 +1,433 @@
+"""
+Filename:    era5_download.py
+Description: Concurrent, resumable downloads of ERA5 data from the CDS
+
+- splits a CDS request into per-year or per-month jobs
+- submits the jobs concurrently with a limit on requests in flight
+  (the CDS queues only a few active requests per user)
+- shares one CDS API client between all jobs
+- retries failed jobs with exponential backoff
+- skips output files that already exist and pass a format and size check
+- downloads to a temporary .part file that is renamed when complete,
+  so an interrupted run never leaves a truncated output file
+- optionally records each file in a catalog (see era5_catalog.py) and
+  skips requests the catalog already holds
+
+Rerunning a script after a failure only downloads the missing files.
+`FakeClient` stands in for cdsapi.Client to test a download without the CDS.
+
+Example:
+    import era5_download as dl
+    request = {'product_type': 'reanalysis', 'variable': 'geopotential',
+               'pressure_level': '500', 'month': dl.MONTHS, 'day': dl.DAYS,
+               'time': ['00:00', '06:00', '12:00', '18:00'], 'format': 'netcdf'}
+    jobs = dl.split_jobs('reanalysis-era5-pressure-levels', request, 1979, 2016,
+                         'era5_z_500_6hr_{year}.nc')
+    results = dl.download_jobs(jobs, max_inflight=4)
+
+"""
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+MONTHS = ['{0:02d}'.format(m) for m in range(1, 13)]
+DAYS = ['{0:02d}'.format(d) for d in range(1, 32)]
+
+# Leading bytes of the file formats returned by the CDS
+MAGIC = {'netcdf': (b'CDF\x01', b'CDF\x02', b'CDF\x05',   # NetCDF classic / 64-bit
+                    b'\x89HDF\r\n\x1a\n'),                # NetCDF4 (HDF5)
+         'grib': (b'GRIB',)}
+
+
+def split_jobs(dataset, request, start_yr, end_yr, target, by='year'):
+    """Split a CDS request into one download job per year or per month
+
+    Parameters
+    ----------
+    dataset : str
+        CDS dataset name (e.g. 'reanalysis-era5-pressure-levels')
+    request : dict
+        CDS request without 'year' (and without 'month' when by='month')
+    start_yr, end_yr : int
+        first and last year (inclusive)
+    target : str
+        output file name with {year} (and {month}) fields,
+        e.g. '/data/z500/era5_z_500_6hr_{year}.nc'
+    by : str, optional
+        'year' (default) or 'month'
+
+    Returns
+    -------
+    jobs : list of dict
+        one dict per output file with keys 'dataset', 'request' and 'target'
+
+    """
+    if by not in ('year', 'month'):
+        raise ValueError("by must be 'year' or 'month'")
+    months = request.get('month', MONTHS) if by == 'month' else [None]
+    if isinstance(months, str):
+        months = [months]
+
+    jobs = []
+    for yr in range(start_yr, end_yr+1):
+        for mon in months:
+            req = dict(request, year='{0}'.format(yr))
+            if mon is not None:
+                req['month'] = mon
+            jobs.append({'dataset': dataset, 'request': req,
+                         'target': target.format(year=yr, month=mon)})
+
+    return jobs
+
+
+def verify_file(path, fmt=None):
+    """Check that a downloaded file exists and looks complete
+
+    The file must start with the signature of a NetCDF (classic or
+    NetCDF4/HDF5) or GRIB file. NetCDF files must be at least as long as
+    their header says (the end of the last variable for classic files,
+    the end-of-file address of the HDF5 superblock for NetCDF4), so a
+    truncated file fails; GRIB files must end with the GRIB end section
+    '7777'.
+
+    Parameters
+    ----------
+    path : str
+        file to check
+    fmt : str, optional
+        expected format, 'netcdf' or 'grib'. Default: None (either)
+
+    Returns
+    -------
+    ok : bool
+
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    if size < 8:
+        return False
+    formats = [fmt] if fmt in MAGIC else list(MAGIC)
+    with open(path, 'rb') as f:
+        head = f.read(8)
+        for name in formats:
+            if head.startswith(MAGIC[name]):
+                f.seek(0)
+                if name == 'grib':
+                    f.seek(-4, os.SEEK_END)
+                    return f.read(4) == b'7777'
+                if head.startswith(b'CDF'):
+                    needed = _classic_size(f)
+                else:
+                    needed = _hdf5_size(f)
+                return needed is not None and size >= needed
+
+    return False
+
+
+# Bytes per value of the NetCDF classic types 1-11
+_NC_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+
+
+def _classic_size(f):
+    """Size in bytes a NetCDF classic file needs according to its header
+
+    Returns None if the header cannot be read (truncated or not NetCDF).
+    """
+    def read(n):
+        data = f.read(n)
+        if len(data) != n:
+            raise EOFError
+        return data
+
+    def uint(n):
+        return int.from_bytes(read(n), 'big')
+
+    def name():
+        read((uint(count) + 3) // 4 * 4)
+
+    try:
+        version = read(4)[3]
+        # CDF-5 uses 64-bit counts and offsets; CDF-2 uses 64-bit offsets
+        count = 8 if version == 5 else 4
+        offset = 4 if version == 1 else 8
+        numrecs = uint(count)
+        if numrecs == 2**(8 * count) - 1:
+            # streaming: the number of records is not in the header
+            numrecs = 0
+
+        dims = []
+        uint(4)
+        for i in range(uint(count)):
+            name()
+            dims.append(uint(count))
+
+        def attributes():
+            uint(4)
+            for i in range(uint(count)):
+                name()
+                nc_type = uint(4)
+                read((uint(count) * _NC_TYPE_SIZES[nc_type] + 3) // 4 * 4)
+
+        attributes()
+        variables = []
+        uint(4)
+        for i in range(uint(count)):
+            name()
+            dimids = [uint(count) for j in range(uint(count))]
+            attributes()
+            nc_type = uint(4)
+            uint(count)
+            begin = uint(offset)
+            nvalues = 1
+            for d in dimids:
+                # the record dimension has length 0
+                nvalues *= dims[d] or 1
+            record = bool(dimids) and dims[dimids[0]] == 0
+            variables.append((begin, nvalues * _NC_TYPE_SIZES[nc_type], record))
+        header = f.tell()
+    except (EOFError, IndexError, KeyError):
+        return None
+
+    # Record variables are interleaved record by record (padded to 4 bytes,
+    # unless there is only one record variable)
+    records = [v for v in variables if v[2]]
+    if len(records) == 1:
+        recsize = records[0][1]
+    else:
+        recsize = sum((v[1] + 3) // 4 * 4 for v in records)
+    needed = header
+    for begin, vsize, record in variables:
+        if record:
+            needed = max(needed, begin + (numrecs - 1) * recsize + vsize if numrecs else 0)
+        else:
+            needed = max(needed, begin + vsize)
+
+    return needed
+
+
+def _hdf5_size(f):
+    """End-of-file address in the superblock of a NetCDF4/HDF5 file, or None"""
+    sb = f.read(48)
+    if len(sb) < 16:
+        return None
+    version = sb[8]
+    if version in (0, 1):
+        nbytes = sb[13]
+        start = 24 + (4 if version == 1 else 0) + 2 * nbytes
+    elif version in (2, 3):
+        nbytes = sb[9]
+        start = 12 + 2 * nbytes
+    else:
+        return None
+    if nbytes not in (2, 4, 8) or len(sb) < start + nbytes:
+        return None
+
+    return int.from_bytes(sb[start:start + nbytes], 'little')
+
+
+def download(job, client, retries=5, backoff=60., max_backoff=900., log=print):
+    """Download one job, retrying with exponential backoff
+
+    The job is skipped if its target already exists and passes `verify_file`.
+    Otherwise it is retrieved to '<target>.part', checked and renamed to
+    the target.
+
+    Parameters
+    ----------
+    job : dict
+        download job from `split_jobs` (keys 'dataset', 'request', 'target')
+    client : cdsapi.Client or FakeClient
+        client whose retrieve(dataset, request, target) downloads the data
+    retries : int, optional
+        number of retries after a failed attempt. Default: 5
+    backoff : float, optional
+        wait before the first retry in seconds, doubled after each failure
+        (with random jitter). Default: 60
+    max_backoff : float, optional
+        longest wait between retries in seconds. Default: 900
+    log : callable, optional
+        function for progress messages. Default: print
+
+    Returns
+    -------
+    result : dict
+        'target', 'status' ('skipped' or 'ok'), 'attempts' and 'seconds'
+
+    """
+    target = job['target']
+    fmt = job['request'].get('format')
+    t0 = time.time()
+    if verify_file(target, fmt):
+        log("Already downloaded: {0}".format(target))
+        return {'target': target, 'status': 'skipped', 'attempts': 0, 'seconds': 0.}
+
+    outdir = os.path.dirname(target)
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+    part = target + '.part'
+    for attempt in range(retries+1):
+        try:
+            client.retrieve(job['dataset'], job['request'], part)
+            if not verify_file(part, fmt):
+                raise IOError("incomplete or invalid file {0}".format(part))
+            os.replace(part, target)
+            break
+        except Exception as err:
+            if os.path.exists(part):
+                os.remove(part)
+            if attempt == retries:
+                raise
+            wait = min(max_backoff, backoff * 2**attempt) * random.uniform(0.5, 1.)
+            log("Download failed ({0}): {1}; retry in {2:.0f} s".format(target, err, wait))
+            time.sleep(wait)
+    log("Download complete: {0}".format(target))
+
+    return {'target': target, 'status': 'ok', 'attempts': attempt+1,
+            'seconds': time.time() - t0}
+
+
+def download_jobs(jobs, client=None, max_inflight=4, retries=5, backoff=60.,
+                  max_backoff=900., log=print, catalog=None):
+    """Download many jobs concurrently with one shared client
+
+    Parameters
+    ----------
+    jobs : list of dict
+        download jobs from `split_jobs`
+    client : cdsapi.Client or FakeClient, optional
+        Default: None (one cdsapi.Client() for all jobs)
+    max_inflight : int, optional
+        maximum number of requests submitted to the CDS at the same time.
+        Keep this within the CDS limit of queued requests per user. Default: 4
+    retries, backoff, max_backoff, log : optional
+        see `download`
+    catalog : era5_catalog.Catalog, optional
+        catalog of downloaded files. Jobs whose request is already in the
+        catalog with an existing file (under any name) are skipped with
+        status 'duplicate' and the 'path' of that file; new downloads are
+        added to the catalog; a file that could not be added keeps its
+        status and gets a 'catalog_error'. Default: None
+
+    Returns
+    -------
+    results : list of dict
+        one result per job, in order (see `download`); jobs that failed
+        after all retries have status 'failed' and the 'error'
+
+    """
+    if client is None:
+        import cdsapi
+        client = cdsapi.Client()
+
+    # Serialize log messages from the worker threads
+    lock = threading.Lock()
+    def _log(msg):
+        with lock:
+            log(msg)
+
+    results = [None] * len(jobs)
+    # The catalog is only used from this thread (sqlite connections are per thread)
+    todo = []
+    for i, job in enumerate(jobs):
+        path = catalog.lookup(job['dataset'], job['request']) if catalog is not None else None
+        if path is not None and os.path.abspath(path) != os.path.abspath(job['target']):
+            _log("Already downloaded as {0}: {1}".format(path, job['target']))
+            results[i] = {'target': job['target'], 'status': 'duplicate', 'path': path,
+                          'attempts': 0, 'seconds': 0.}
+        else:
+            todo.append(i)
+
+    with ThreadPoolExecutor(max_workers=max_inflight) as pool:
+        futures = {pool.submit(download, jobs[i], client, retries, backoff, max_backoff, _log): i
+                   for i in todo}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as err:
+                _log("Download failed: {0}: {1}".format(jobs[i]['target'], err))
+                results[i] = {'target': jobs[i]['target'], 'status': 'failed',
+                              'attempts': retries+1, 'error': str(err)}
+                continue
+            # The file is complete: a catalog error does not fail the download
+            if catalog is not None:
+                try:
+                    catalog.add_job(jobs[i])
+                except Exception as err:
+                    _log("Could not add {0} to the catalog: {1}".format(jobs[i]['target'], err))
+                    results[i]['catalog_error'] = str(err)
+
+    nfailed = sum(r['status'] == 'failed' for r in results)
+    _log("{0} files: {1} downloaded, {2} skipped, {3} failed".format(
+        len(results), sum(r['status'] == 'ok' for r in results),
+        sum(r['status'] in ('skipped', 'duplicate') for r in results), nfailed))
+    ncatalog = sum('catalog_error' in r for r in results)
+    if ncatalog:
+        _log("{0} files not added to the catalog (see 'catalog_error')".format(ncatalog))
+
+    return results
+
+
+class FakeClient(object):
+    """Local stand-in for cdsapi.Client, for testing downloads without the CDS
+
+    retrieve() writes a small file with a valid NetCDF or GRIB signature
+    (following request['format']) after an optional delay, and can fail
+    at random to exercise the retry logic.
+
+    Parameters
+    ----------
+    delay : float, optional
+        seconds per retrieve. Default: 0
+    fail_rate : float, optional
+        probability that a retrieve raises an exception. Default: 0
+    truncate_rate : float, optional
+        probability that a retrieve writes a truncated (invalid) file. Default: 0
+    seed : int, optional
+        random seed
+
+    Attributes
+    ----------
+    calls : list of (dataset, request, target)
+        every retrieve call, in order
+    max_active : int
+        largest number of retrieve calls running at the same time
+
+    """
+    def __init__(self, delay=0., fail_rate=0., truncate_rate=0., seed=None):
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.truncate_rate = truncate_rate
+        self.calls = []
+        self.max_active = 0
+        self._active = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def retrieve(self, name, request, target=None):
+        with self._lock:
+            self.calls.append((name, dict(request), target))
+            self._active += 1
+            self.max_active = max(self.max_active, self._active)
+            fail = self._random.random() < self.fail_rate
+            truncate = self._random.random() < self.truncate_rate
+        try:
+            time.sleep(self.delay)
+            if fail:
+                raise RuntimeError("fake CDS request failed")
+            if request.get('format') == 'grib':
+                data = b'GRIB' + bytes(100) + b'7777'
+            else:
+                data = b'CDF\x01' + bytes(100)
+            with open(target, 'wb') as f:
+                f.write(data[:6] if truncate else data)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+        return target
@@ -0,0 +1,446 @@
+"""
+Filename:    era5_plan.py
+Description: Plan ERA5 retrievals: estimate request sizes and split or
+             merge them into chunks of a target size
+
+- estimates the number of fields (variables x levels x dates x times) and
+  the download size (fields x grid points of the area) of a CDS request
+- re-chunks the dates of one or more requests so that each request is
+  close to a target size and below the CDS limit on fields per request:
+  large requests are split, small requests for the same data are merged
+- for 'reanalysis-era5-complete' (MARS) requests all parameters and levels
+  of a date stay in one request and a request never spans two months, so
+  each request reads data that is stored together on tape
+- prints the plan before anything is downloaded
+
+Requests use the same keys as the CDS scripts in this directory: either
+'year'/'month'/'day' or 'date' (e.g. '20180706/to/20180707' for MARS,
+'2018-07-06/2018-07-07' for the CDS datasets), 'time' as a list or MARS
+string ('00/to/23/by/3'), 'variable' or 'param', 'pressure_level' or
+'levelist', and optional 'area' [N, W, S, E] and 'grid' [dx, dy].
+
+Example:
+    import era5_plan
+    jobs = era5_plan.plan('reanalysis-era5-pressure-levels', request,
+                          '/data/z500/era5_z_500_6hr_{start}_{end}.nc',
+                          target_mb=500)
+    era5_plan.run_plan(jobs, max_inflight=4)
+
+"""
+import os
+import datetime
+import itertools
+
+
+# Default limit on fields per request (CDS 'items' limit for the ERA5 datasets)
+MAX_FIELDS = 120000
+
+# ERA5 GRIB and CDS NetCDF files pack each value into 16 bits
+BYTES_PER_VALUE = 2
+
+# Keys that select dates; they are replaced by 'date' in planned requests
+DATE_KEYS = ('date', 'year', 'month', 'day')
+
+
+def _is_mars(dataset):
+    """True for datasets that take MARS request syntax"""
+    return dataset == 'reanalysis-era5-complete'
+
+
+def request_values(value):
+    """Items of a request value given as a list or a '/' separated string"""
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value]
+    return [v for v in str(value).split('/') if v != '']
+
+
+def _int(token, hours=False):
+    """Integer of a level or day token, or hour of a time token ('12', '12:00', '1200')"""
+    if ':' in token:
+        return int(token.split(':')[0])
+    if hours and len(token) == 4:
+        return int(token) // 100
+    return int(token)
+
+
+def expand_ints(value, hours=False):
+    """Expand a MARS list such as '1/to/137' or '0/to/23/by/3' to integers
+
+    hours=True reads time tokens ('12', '12:00' or '1200') as hours.
+    """
+    tokens = request_values(value)
+    out = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == 'to':
+            step = int(tokens[i+3]) if tokens[i+2:i+3] == ['by'] else 1
+            out.extend(range(out.pop(), _int(tokens[i+1], hours)+1, step))
+            i += 4 if tokens[i+2:i+3] == ['by'] else 2
+        else:
+            out.append(_int(tokens[i], hours))
+            i += 1
+
+    return out
+
+
+def _parse_date(token):
+    """datetime.date from 'YYYYMMDD' or 'YYYY-MM-DD'"""
+    token = token.replace('-', '')
+    return datetime.date(int(token[0:4]), int(token[4:6]), int(token[6:8]))
+
+
+def _date_range(start, end, step=1):
+    n = (end - start).days
+    return [start + datetime.timedelta(days=d) for d in range(0, n+1, step)]
+
+
+def expand_dates(dataset, request):
+    """Sorted list of the dates selected by a request
+
+    Parameters
+    ----------
+    dataset : str
+        CDS dataset name
+    request : dict
+        CDS request with 'date' or 'year'/'month'/'day'
+
+    Returns
+    -------
+    dates : list of datetime.date
+
+    """
+    if 'date' in request:
+        tokens = request_values(request['date'])
+        if not _is_mars(dataset) and len(tokens) == 2 and 'to' not in tokens:
+            # CDS datasets: 'start/end' is a range
+            tokens = [tokens[0], 'to', tokens[1]]
+        dates = []
+        i = 0
+        while i < len(tokens):
+            if tokens[i] == 'to':
+                step = int(tokens[i+3]) if tokens[i+2:i+3] == ['by'] else 1
+                dates.extend(_date_range(dates.pop(), _parse_date(tokens[i+1]), step))
+                i += 4 if tokens[i+2:i+3] == ['by'] else 2
+            else:
+                dates.append(_parse_date(tokens[i]))
+                i += 1
+    else:
+        dates = []
+        for yr, mon, day in itertools.product(expand_ints(request['year']),
+                                              expand_ints(request.get('month', '1/to/12')),
+                                              expand_ints(request.get('day', '1/to/31'))):
+            try:
+                dates.append(datetime.date(yr, mon, day))
+            except ValueError:
+                pass   # e.g. 31 April; the CDS skips these too
+
+    return sorted(set(dates))
+
+
+def _nvariables(request):
+    return len(request_values(request.get('variable', request.get('param', ''))))
+
+
+def request_levels(request):
+    """Levels selected by a request; [None] for single level data"""
+    if request.get('levtype') != 'sfc':
+        for key in ('pressure_level', 'levelist', 'model_level'):
+            if key in request:
+                return expand_ints(request[key])
+    return [None]
+
+
+def request_area(request):
+    """Area [N, W, S, E] of a request (default: global)"""
+    return [float(a) for a in request_values(request.get('area', [90, -180, -90, 180]))]
+
+
+def request_grid(request):
+    """Grid spacing [dx, dy] of a request (default: 0.25 x 0.25)"""
+    return [float(g) for g in request_values(request.get('grid', [0.25, 0.25]))]
+
+
+def _nlevels(request):
+    return len(request_levels(request))
+
+
+def _ntimes(request):
+    return len(expand_ints(request.get('time', '00:00'), hours=True))
+
+
+def _npoints(request):
+    """Number of grid points per field for the area and grid of a request"""
+    north, west, south, east = request_area(request)
+    grid = request_grid(request)
+    nlat = int(round((north - south) / grid[1])) + 1
+    nlon = int(round((east - west) / grid[0])) + 1
+    # a global request has no repeated 180 meridian
+    nlon = min(nlon, int(round(360. / grid[0])))
+
+    return nlat * nlon
+
+
+def estimate(dataset, request):
+    """Estimate the number of fields and download size of a request
+
+    Returns
+    -------
+    est : dict
+        'dates', 'times', 'variables', 'levels', 'points' (per field),
+        'fields' (variables x levels x dates x times) and 'mb' (size in MB)
+
+    """
+    est = {'dates': len(expand_dates(dataset, request)),
+           'times': _ntimes(request),
+           'variables': _nvariables(request),
+           'levels': _nlevels(request),
+           'points': _npoints(request)}
+    est['fields'] = est['dates'] * est['times'] * est['variables'] * est['levels']
+    est['mb'] = est['fields'] * est['points'] * BYTES_PER_VALUE / 1e6
+
+    return est
+
+
+def _date_request(dataset, request, dates):
+    """Copy of request selecting the contiguous dates[0] to dates[-1]"""
+    req = {k: v for k, v in request.items() if k not in DATE_KEYS}
+    if _is_mars(dataset):
+        fmt = '{0:%Y%m%d}'
+        sep = '/to/'
+    else:
+        fmt = '{0:%Y-%m-%d}'
+        sep = '/'
+    if len(dates) == 1:
+        req['date'] = fmt.format(dates[0])
+    else:
+        req['date'] = fmt.format(dates[0]) + sep + fmt.format(dates[-1])
+
+    return req
+
+
+def _runs(dates):
+    """Split sorted dates into runs of consecutive days"""
+    runs = [[dates[0]]]
+    for d in dates[1:]:
+        if (d - runs[-1][-1]).days == 1:
+            runs[-1].append(d)
+        else:
+            runs.append([d])
+
+    return runs
+
+
+def _chunk_dates(dates, ndays, by_month):
+    """Split sorted dates into contiguous chunks of at most ndays
+
+    Chunks never span a gap in the dates. If by_month, chunks never span
+    two months; chunks of a month or more are aligned to whole months
+    (whole years for chunks of a year or more).
+    """
+    chunks = []
+    for run in _runs(dates):
+        if ndays >= 366 and not by_month:
+            key = lambda d: d.year
+        elif ndays >= 28 or by_month:
+            key = lambda d: (d.year, d.month)
+        else:
+            key = None
+        if key is None:
+            groups = [run]
+        else:
+            groups = [list(g) for k, g in itertools.groupby(run, key)]
+        # merge whole periods up to ndays, split periods longer than ndays
+        current = []
+        for g in groups:
+            if current and (by_month or len(current) + len(g) > ndays):
+                chunks.append(current)
+                current = []
+            if len(g) > ndays:
+                # equal chunks rather than a short one at the end
+                n = -(-len(g) // ndays)
+                bounds = [len(g) * k // n for k in range(n+1)]
+                chunks.extend(g[bounds[k]:bounds[k+1]] for k in range(n-1))
+                g = g[bounds[n-1]:]
+            current = current + g
+        if current:
+            chunks.append(current)
+
+    return chunks
+
+
+def _target_name(target, dates, nchunks):
+    """Output file name for a chunk from a template with {start}, {end}, {year}, {month}"""
+    fields = {'start': '{0:%Y%m%d}'.format(dates[0]), 'end': '{0:%Y%m%d}'.format(dates[-1]),
+              'year': dates[0].year, 'month': '{0:02d}'.format(dates[0].month)}
+    if nchunks > 1 and '{' not in target:
+        root, ext = os.path.splitext(target)
+        target = root + '_{start}_{end}' + ext
+
+    return target.format(**fields)
+
+
+def _split_list(request, key, n):
+    """Split the '/' or list valued request[key] into n requests"""
+    items = request_values(request[key])
+    size = -(-len(items) // n)
+    reqs = []
+    for i in range(0, len(items), size):
+        part = items[i:i+size]
+        value = part if isinstance(request[key], (list, tuple)) else '/'.join(part)
+        reqs.append(dict(request, **{key: value}))
+
+    return reqs
+
+
+def plan(dataset, request, target, target_mb=2000., max_fields=MAX_FIELDS):
+    """Split or merge the dates of a request into requests of about target_mb
+
+    Parameters
+    ----------
+    dataset : str
+        CDS dataset name
+    request : dict
+        CDS request (see module docstring)
+    target : str
+        output file template with optional {start}, {end} (YYYYMMDD),
+        {year} and {month} fields of the first and last date of a request.
+        Without fields, '_{start}_{end}' is added when there is more than
+        one request.
+    target_mb : float, optional
+        target size of one request in MB. Default: 2000
+    max_fields : int, optional
+        maximum number of fields per request. Default: MAX_FIELDS
+
+    Returns
+    -------
+    jobs : list of dict
+        download jobs (keys 'dataset', 'request', 'target', as from
+        era5_download.split_jobs) with the estimated 'fields' and 'mb'
+
+    """
+    return _plan(dataset, request, expand_dates(dataset, request), target,
+                 target_mb, max_fields)
+
+
+def _plan(dataset, request, dates, target, target_mb, max_fields):
+    """Body of `plan` for the given list of dates"""
+    base = {k: v for k, v in request.items() if k not in DATE_KEYS}
+    est = estimate(dataset, dict(base, date='20000101'))
+    fields_per_day = est['fields']
+    mb_per_day = est['mb']
+
+    # If one day is already too large, split the variables (CDS) or the
+    # times of the day (MARS: the parameters of a date are stored together)
+    parts = [base]
+    nparts = max(-(-fields_per_day // max_fields), int(-(-mb_per_day // target_mb)))
+    if nparts > 1:
+        key = 'time' if _is_mars(dataset) else ('variable' if 'variable' in base else 'param')
+        if key == 'time':
+            base = dict(base, time=['{0:02d}'.format(h) for h in expand_ints(base['time'], hours=True)])
+        parts = _split_list(base, key, nparts)
+        fields_per_day = max(estimate(dataset, dict(p, date='20000101'))['fields'] for p in parts)
+        mb_per_day = mb_per_day * fields_per_day / est['fields']
+
+    ndays = int(max(1, min(max_fields // max(fields_per_day, 1),
+                           target_mb // max(mb_per_day, 1e-9))))
+    chunks = _chunk_dates(dates, ndays, by_month=_is_mars(dataset))
+
+    jobs = []
+    njobs = len(chunks) * len(parts)
+    for i, part in enumerate(parts):
+        for chunk in chunks:
+            req = _date_request(dataset, part, chunk)
+            name = _target_name(target, chunk, njobs)
+            if len(parts) > 1:
+                root, ext = os.path.splitext(name)
+                name = '{0}_part{1}{2}'.format(root, i+1, ext)
+            est = estimate(dataset, req)
+            jobs.append({'dataset': dataset, 'request': req, 'target': name,
+                         'fields': est['fields'], 'mb': est['mb']})
+
+    return jobs
+
+
+def plan_jobs(jobs, target=None, target_mb=2000., max_fields=MAX_FIELDS):
+    """Re-plan a list of download jobs, merging jobs that differ only in dates
+
+    Jobs with the same dataset and request apart from the dates (e.g. the
+    per-year jobs of era5_download.split_jobs) are pooled and re-chunked
+    with `plan`.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        download jobs (keys 'dataset', 'request', 'target')
+    target : str, optional
+        output file template (see `plan`). Default: the target of the first
+        job of each group
+    target_mb, max_fields : optional
+        see `plan`
+
+    Returns
+    -------
+    jobs : list of dict
+        planned download jobs
+
+    """
+    groups = {}
+    for job in jobs:
+        base = {k: v for k, v in job['request'].items() if k not in DATE_KEYS}
+        key = (job['dataset'], repr(sorted(base.items())))
+        group = groups.setdefault(key, {'job': job, 'dates': set()})
+        group['dates'].update(expand_dates(job['dataset'], job['request']))
+
+    planned = []
+    for group in groups.values():
+        job = group['job']
+        planned.extend(_plan(job['dataset'], job['request'], sorted(group['dates']),
+                             target or job['target'], target_mb, max_fields))
+
+    return planned
+
+
+def print_plan(jobs, max_fields=MAX_FIELDS):
+    """Print one line per request with its dates, fields and estimated size"""
+    print('{0:>4}  {1:<30} {2:>9} {3:>10}  {4}'.format('#', 'date', 'fields', 'MB', 'target'))
+    for i, job in enumerate(jobs):
+        if 'fields' not in job:
+            job.update({k: v for k, v in estimate(job['dataset'], job['request']).items()
+                        if k in ('fields', 'mb')})
+        flag = '  > max_fields' if job['fields'] > max_fields else ''
+        date = job['request'].get('date', job['request'].get('year', ''))
+        if isinstance(date, (list, tuple)):
+            date = '{0}..{1}'.format(date[0], date[-1])
+        print('{0:>4}  {1:<30} {2:>9} {3:>10.1f}  {4}{5}'.format(
+            i+1, str(date), job['fields'], job['mb'], job['target'], flag))
+    print('{0} requests, {1} fields, {2:.1f} MB'.format(
+        len(jobs), sum(j['fields'] for j in jobs), sum(j['mb'] for j in jobs)))
+
+
+def run_plan(jobs, client=None, dry_run=False, max_fields=MAX_FIELDS, **kwargs):
+    """Print the plan, then download the jobs with era5_download.download_jobs
+
+    Parameters
+    ----------
+    jobs : list of dict
+        download jobs
+    client : optional
+        CDS client (see era5_download.download_jobs)
+    dry_run : bool, optional
+        only print the plan. Default: False
+    kwargs : optional
+        passed to era5_download.download_jobs (max_inflight, retries, ...)
+
+    Returns
+    -------
+    results : list of dict or None
+        download results (None for a dry run)
+
+    """
+    import era5_download
+
+    print_plan(jobs, max_fields)
+    if dry_run:
+        return None
+
+    return era5_download.download_jobs(jobs, client=client, **kwargs)
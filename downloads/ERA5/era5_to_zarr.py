@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+Filename:    era5_to_zarr.py
+Description: Append downloaded ERA5 NetCDF/GRIB files to a chunked Zarr store
+
+- appends each file along time, so new years are added without
+  rewriting the store; files already in the store are skipped
+- chunking for the way the data are read:
+    'time' : long time chunks on small tiles of the grid, for time series
+             of grid points (daily climatology, harmonics, EOFs)
+    'map'  : short time chunks of whole maps, for maps and animations
+    'both' : one copy of each, in the groups 'time' and 'map' of the store
+- Blosc compression (zstd by default) with byte shuffle
+- unpacks the 16-bit packed CDS files to float32 (or keeps the packing)
+- writes consolidated metadata, so opening the store reads one file
+
+Usage:
+    python era5_to_zarr.py /data/z500.zarr /data/downloads/z500/era5_z_500_6hr_*.nc
+    python era5_to_zarr.py /data/z500.zarr new/*.nc --layout both --space-chunk 40
+
+    ds = open_store('/data/z500.zarr', layout='time')
+
+"""
+import os
+import argparse
+import time
+
+import numpy as np
+import xarray as xr
+
+
+TIME_NAMES = ('time', 'valid_time')
+LAT_NAMES = ('latitude', 'lat')
+LON_NAMES = ('longitude', 'lon')
+
+
+def _find(names, candidates):
+    return next((n for n in candidates if n in names), None)
+
+
+def open_download(path):
+    """Open a downloaded NetCDF or GRIB file (GRIB needs cfgrib)"""
+    if os.path.splitext(path)[1] in ('.grib', '.grb', '.grib2'):
+        return xr.open_dataset(path, engine='cfgrib')
+    return xr.open_dataset(path)
+
+
+def _compression(cname, clevel):
+    """Encoding entries for Blosc compression (zarr 2 and zarr 3 APIs)"""
+    import zarr
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        from zarr.codecs import BloscCodec
+        return {'compressors': (BloscCodec(cname=cname, clevel=clevel, shuffle='shuffle'),)}
+    from numcodecs import Blosc
+    return {'compressor': Blosc(cname=cname, clevel=clevel, shuffle=Blosc.SHUFFLE)}
+
+
+def layout_chunks(ds, layout, time_chunk=None, space_chunk=32):
+    """Chunk sizes per dimension for a layout
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        data of the first file
+    layout : str
+        'time' (long time series on space_chunk x space_chunk tiles) or
+        'map' (time_chunk whole maps)
+    time_chunk : int, optional
+        time steps per chunk. Default: all time steps of ds (e.g. one year)
+        for 'time', 24 for 'map'
+    space_chunk : int, optional
+        grid points per chunk along latitude and longitude for 'time'.
+        Default: 32
+
+    Returns
+    -------
+    chunks : dict
+        chunk size of each dimension (1 for other dimensions such as level)
+
+    """
+    tname = _find(ds.dims, TIME_NAMES)
+    latname = _find(ds.dims, LAT_NAMES)
+    lonname = _find(ds.dims, LON_NAMES)
+    chunks = {d: 1 for d in ds.dims}
+    if layout == 'time':
+        chunks[tname] = time_chunk or ds.sizes[tname]
+        chunks[latname] = min(space_chunk, ds.sizes[latname])
+        chunks[lonname] = min(space_chunk, ds.sizes[lonname])
+    elif layout == 'map':
+        chunks[tname] = min(time_chunk or 24, ds.sizes[tname])
+        chunks[latname] = ds.sizes[latname]
+        chunks[lonname] = ds.sizes[lonname]
+    else:
+        raise ValueError("layout must be 'time' or 'map'")
+
+    return chunks
+
+
+def _prepare(ds, float32):
+    """Drop the encoding of the source file and unpack to float32"""
+    ds = ds.copy()
+    for name, var in ds.variables.items():
+        keep = {k: v for k, v in var.encoding.items() if k in ('units', 'calendar')}
+        var.encoding = keep
+        if float32 and name not in ds.coords and np.issubdtype(var.dtype, np.floating):
+            ds[name] = var.astype('float32')
+    return ds
+
+
+def _encoding(ds, chunks, float32, packing, cname, clevel):
+    """Encoding of every variable for a new store"""
+    tname = _find(ds.dims, TIME_NAMES)
+    encoding = {}
+    for name, var in ds.variables.items():
+        if var.dims == (tname,):
+            encoding[name] = {'chunks': (max(chunks[tname], 1024),)}
+            if name == tname:
+                encoding[name].update(units='hours since 1900-01-01', dtype='int64')
+            continue
+        if name in ds.coords:
+            continue
+        enc = {'chunks': tuple(chunks[d] for d in var.dims)}
+        enc.update(_compression(cname, clevel))
+        if not float32 and name in packing:
+            enc.update(packing[name])
+        encoding[name] = enc
+    return encoding
+
+
+def _packing(ds):
+    """16-bit packing (dtype, scale factor, offset, fill value) of each variable"""
+    return {name: {k: var.encoding[k] for k in ('dtype', 'scale_factor', 'add_offset',
+                                                 '_FillValue') if k in var.encoding}
+            for name, var in ds.data_vars.items()}
+
+
+def _aligned(ds, tname, nexisting, tchunk):
+    """Rechunk ds so that its time chunks line up with the chunks of the store"""
+    n = ds.sizes[tname]
+    first = (tchunk - nexisting % tchunk) % tchunk or tchunk
+    sizes = [min(first, n)]
+    while sum(sizes) < n:
+        sizes.append(min(tchunk, n - sum(sizes)))
+    return ds.chunk({tname: tuple(sizes)})
+
+
+def append_to_zarr(files, store, layout='time', time_chunk=None, space_chunk=32,
+                   cname='zstd', clevel=5, float32=True, consolidated=True, log=print):
+    """Append NetCDF/GRIB files to a Zarr store along time
+
+    Files are appended in time order. The store records the files it
+    holds (attribute 'source_files'), and files that are already in the
+    store, or that do not start after its last time step, are skipped, so
+    the function can be rerun on a growing list of downloads.
+
+    Parameters
+    ----------
+    files : list of str
+        downloaded files with the same variables and grid
+    store : str
+        path of the Zarr store, created if missing
+    layout : str, optional
+        'time', 'map' or 'both' (see layout_chunks). 'both' writes the two
+        layouts to the groups 'time' and 'map' of the store. Default: 'time'
+    time_chunk, space_chunk : int, optional
+        see layout_chunks
+    cname : str, optional
+        Blosc compressor ('zstd', 'lz4', 'blosclz', ...). Default: 'zstd'
+    clevel : int, optional
+        compression level 1-9. Default: 5
+    float32 : bool, optional
+        store the data as float32. False keeps the 16-bit packing (scale
+        factor and offset) of the first file; files packed differently
+        (CDS packs each file with its own range) raise ValueError.
+        Default: True
+    consolidated : bool, optional
+        write consolidated metadata. Default: True
+    log : callable, optional
+        function for progress messages. Default: print
+
+    Returns
+    -------
+    appended : list of str or dict
+        files appended to the store; for layout='both' a dict with the
+        files appended to each group, {'time': [...], 'map': [...]}
+
+    """
+    if layout == 'both':
+        return {group: _append(files, store, group, group, time_chunk, space_chunk,
+                               cname, clevel, float32, consolidated, log)
+                for group in ('time', 'map')}
+
+    return _append(files, store, layout, None, time_chunk, space_chunk,
+                   cname, clevel, float32, consolidated, log)
+
+
+def _append(files, store, layout, group, time_chunk, space_chunk, cname, clevel,
+            float32, consolidated, log):
+    """append_to_zarr for one layout / group"""
+    # What is in the store already
+    try:
+        existing = xr.open_zarr(store, group=group, consolidated=None)
+    except (FileNotFoundError, KeyError, ValueError, OSError):
+        existing = None
+    if existing is not None:
+        done = set(existing.attrs.get('source_files', []))
+        tname = _find(existing.dims, TIME_NAMES)
+        last = existing[tname].values[-1]
+        nexisting = existing.sizes[tname]
+        var = next(v for v in existing.data_vars.values() if tname in v.dims)
+        tchunk = var.encoding['chunks'][var.dims.index(tname)]
+        store_packing = _packing(existing)
+        existing.close()
+    else:
+        done, last, nexisting, tchunk, store_packing = set(), None, 0, None, None
+
+    # Sort the new files by their first time step
+    todo = []
+    for path in files:
+        name = os.path.basename(path)
+        if name in done:
+            continue
+        with open_download(path) as ds:
+            t0 = ds[_find(ds.dims, TIME_NAMES)].values[0]
+            packing = _packing(ds)
+        todo.append((t0, path, packing))
+    todo.sort(key=lambda item: item[0])
+
+    # Packed stores keep the scale factor and offset of their first file;
+    # CDS files are packed with their own range, so refuse to mix them
+    # before anything is written
+    if not float32:
+        for t0, path, packing in todo:
+            if store_packing is None:
+                store_packing = packing
+            elif packing != store_packing:
+                raise ValueError("{0} is packed differently from {1}; its values would be "
+                                 "clipped. Append with float32=True".format(path, store))
+
+    appended = []
+    where = store if group is None else '{0} ({1})'.format(store, group)
+    for t0, path, packing in todo:
+        if last is not None and t0 <= last:
+            log("Skipped {0}: starts before the end of {1}".format(path, where))
+            continue
+        start = time.time()
+        ds = open_download(path)
+        tname = _find(ds.dims, TIME_NAMES)
+        ds = _prepare(ds, float32)
+        done.add(os.path.basename(path))
+        ds.attrs['source_files'] = sorted(done)
+        if tchunk is None:
+            chunks = layout_chunks(ds, layout, time_chunk, space_chunk)
+            tchunk = chunks[tname]
+            ds = ds.chunk(chunks)
+            ds.to_zarr(store, group=group, mode='w' if group is None else 'a',
+                       encoding=_encoding(ds, chunks, float32, packing, cname, clevel),
+                       consolidated=consolidated)
+        else:
+            chunks = layout_chunks(ds, layout, tchunk, space_chunk)
+            ds = _aligned(ds.chunk(chunks), tname, nexisting, tchunk)
+            ds.to_zarr(store, group=group, append_dim=tname, consolidated=consolidated)
+        nexisting += ds.sizes[tname]
+        last = ds[tname].values[-1]
+        ds.close()
+        appended.append(path)
+        log("Appended {0} to {1} ({2:.1f} s)".format(path, where, time.time() - start))
+
+    return appended
+
+
+def open_store(store, layout=None):
+    """Open a store written by append_to_zarr
+
+    layout selects the group of a store written with layout='both'
+    ('time' or 'map').
+    """
+    return xr.open_zarr(store, group=layout, consolidated=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('store', help='Zarr store (created if missing)')
+    parser.add_argument('files', nargs='+', help='downloaded NetCDF/GRIB files')
+    parser.add_argument('--layout', default='time', choices=['time', 'map', 'both'])
+    parser.add_argument('--time-chunk', type=int, default=None)
+    parser.add_argument('--space-chunk', type=int, default=32)
+    parser.add_argument('--cname', default='zstd')
+    parser.add_argument('--clevel', type=int, default=5)
+    parser.add_argument('--packed', action='store_true',
+                        help='keep the 16-bit packing instead of float32')
+    args = parser.parse_args()
+
+    append_to_zarr(args.files, args.store, layout=args.layout, time_chunk=args.time_chunk,
+                   space_chunk=args.space_chunk, cname=args.cname, clevel=args.clevel,
+                   float32=not args.packed)
+
+
+if __name__ == '__main__':
+    main()
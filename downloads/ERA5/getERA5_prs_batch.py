@@ -3,8 +3,14 @@ Filename:    getERA5_prs_batch.py
 Author:      Tessa Montini, tmontini@ucsb.edu
 Description: Download multi-year ERA5 data on pressure levels
 
+- one file per year, downloaded concurrently (see era5_download.py)
+- rerun after a failure to download only the missing years
+- prints the estimated size of each request first (see era5_plan.py)
+
 """
-import cdsapi
+import era5_download as dl
+import era5_plan
+from era5_catalog import Catalog
 
 # Data directory and file names
 datadir = "/Users/tessamontini/Google_Drive/DATA/downloads/z500/"
@@ -20,36 +26,25 @@ end_yr   = 2016
 area = [20, -165, -60, -12]   # [N,W,S,E] Default: global
 grid = [0.5, 0.5]             # Default: 0.25 x 0.25
 
+# Download options
+max_inflight = 4              # CDS requests submitted at the same time
+client = None                 # Default: cdsapi.Client(); dl.FakeClient() to test
+catalog_file = None           # e.g. datadir + 'era5_catalog.sqlite' to record downloads
+
 
-# Loop for downloading annual data files
-for yr in range(start_yr,end_yr+1):
-    outfile = datadir + "{0}_{1}.nc".format(fprefix, yr)
-    c = cdsapi.Client()
-    c.retrieve('reanalysis-era5-pressure-levels', 
-               {'product_type'  : 'reanalysis',
-                'pressure_level': level,
-                'variable'      : var,
-                'year'          : "{0}".format(yr),
-                'month'         : ['01','02','03',
-                                   '04','05','06',
-                                   '07','08','09',
-                                   '10','11','12'],
-                'day'           : ['01','02','03',
-                                   '04','05','06',
-                                   '07','08','09',
-                                   '10','11','12',
-                                   '13','14','15',
-                                   '16','17','18',
-                                   '19','20','21',
-                                   '22','23','24',
-                                   '25','26','27',
-                                   '28','29','30',
-                                   '31'],
-                'time'          : ['00:00','06:00',
-                                   '12:00','18:00'],
-                'area'          : area,
-                'grid'          : grid,
-                'format'        : 'netcdf'
-               },
-               outfile)
-    print("Download complete: {filename} \n".format(filename=outfile))
+# Split into annual data files and download
+request = {'product_type'  : 'reanalysis',
+           'pressure_level': level,
+           'variable'      : var,
+           'month'         : dl.MONTHS,
+           'day'           : dl.DAYS,
+           'time'          : ['00:00','06:00',
+                              '12:00','18:00'],
+           'area'          : area,
+           'grid'          : grid,
+           'format'        : 'netcdf'
+          }
+jobs = dl.split_jobs('reanalysis-era5-pressure-levels', request, start_yr, end_yr,
+                     datadir + fprefix + "_{year}.nc")
+catalog = Catalog(catalog_file) if catalog_file else None
+era5_plan.run_plan(jobs, client=client, max_inflight=max_inflight, catalog=catalog)
@@ -46,6 +46,12 @@ def spatial_weights(latitude):
 def calc_eofs(z):
     """Eigenvector decomposition of covariance/correlation matrix
     
+    Uses the symmetric eigensolver (np.linalg.eigh), so the eigenpairs are
+    real and sorted in descending order of eigenvalue. When there are fewer
+    observations than variables (n < p) the [n x n] temporal covariance
+    matrix is decomposed instead of the [p x p] spatial one, and its
+    eigenvectors are mapped back to the spatial eigenvectors.
+    
     Parameters
     ----------
     z : array_like, float
@@ -56,17 +62,39 @@ def calc_eofs(z):
     Returns
     -------
     evals : array_like, float
-        vector of eigenvalues of size [p]
+        vector of eigenvalues of size [p] in descending order
+        (size [r] when n < p, where r <= n is the rank of z)
     evecs : array_like, float
         pxp matrix of eigenvectors (columns)
+        (pxr when n < p)
     
     """
-    # Compute covariance/correlation matix [R]
-    ntot = z.shape[0]
-    R = np.matmul(z.T,z) / (ntot - 1.)
+    ntot, nvar = z.shape
+    
+    if ntot >= nvar:
+        # Compute covariance/correlation matix [R]
+        R = np.matmul(z.T, z) / (ntot - 1.)
 
-    # Eigenvector decomposition of R
-    evals, evecs = np.linalg.eig(R)
+        # Eigenvector decomposition of R
+        evals, evecs = np.linalg.eigh(R)
+        evals = evals[::-1]
+        evecs = evecs[:, ::-1]
+    else:
+        # Compute temporal covariance matrix [n x n]
+        G = np.matmul(z, z.T) / (ntot - 1.)
+        evals, u = np.linalg.eigh(G)
+        evals = evals[::-1]
+        u = u[:, ::-1]
+        
+        # Keep the non-null modes and map back to spatial eigenvectors;
+        # z.T u has norm sqrt((n-1) * eval)
+        tol = evals[0] * max(z.shape) * np.finfo(evals.dtype).eps
+        rank = np.count_nonzero(evals > tol)
+        evals = evals[0:rank]
+        evecs = np.matmul(z.T, u[:, 0:rank]) / np.sqrt((ntot - 1.) * evals)
+    
+    # Round-off can leave tiny negative eigenvalues
+    evals = np.clip(evals, 0., None)
 
     return evals, evecs
 
@@ -95,6 +123,107 @@ def calc_pcs(z, evecs, npcs):
     return pcs
 
 
+def iter_project_pcs(chunks, evecs, npcs=None, weights=None):
+    """Project a stream of data chunks onto existing eigenvectors
+    
+    Generator counterpart of `project_pcs`: each chunk is projected with a
+    single matrix multiplication and its pcs are yielded before the next
+    chunk is read, so memory stays bounded by the chunk size.
+    
+    Parameters
+    ----------
+    chunks : iterable of array_like, float
+        data chunks of shape [..., p] with any number of leading
+        (e.g. member, lead, time) dimensions; NaNs mark missing points
+    evecs : array_like, float
+        pxk matrix of eigenvectors (columns)
+    npcs : scalar, int, optional
+        number of pcs to return. Defaults to all k
+    weights : array_like, float, optional
+        weights of size [p] (e.g. `spatial_weights` on the flattened grid)
+        applied to the data before projection
+        
+    Yields
+    ------
+    pcs : array_like, float
+        principal components of each chunk, shape [npcs, ...]
+    
+    """
+    evecs = evecs[:, 0:npcs]
+    # Fold the weights into the eigenvectors once instead of into every chunk
+    if weights is not None:
+        evecs = evecs * np.reshape(weights, (-1, 1))
+    nvar, npcs = evecs.shape
+    
+    for chunk in chunks:
+        chunk = np.asarray(chunk)
+        if chunk.shape[-1] != nvar:
+            raise ValueError("chunks must have {0} points in the last dimension "
+                             "(rows of evecs), got {1}".format(nvar, chunk.shape[-1]))
+        batch_shape = chunk.shape[:-1]
+        z = chunk.reshape(-1, nvar)
+        if not np.issubdtype(z.dtype, np.floating):
+            z = z.astype(float)
+        
+        # Masked projection: missing points do not contribute
+        valid = np.isfinite(z)
+        if not valid.all():
+            z = np.where(valid, z, 0.)
+        pcs = np.matmul(z, evecs)
+        pcs[~valid.any(axis=1)] = np.nan
+        
+        yield pcs.T.reshape((npcs,) + batch_shape)
+        
+
+def project_pcs(z, evecs, npcs=None, weights=None, chunksize=4096):
+    """Project fields with arbitrary leading dimensions onto existing eigenvectors
+    
+    Vectorized `calc_pcs` for ensembles and forecast streams: all leading
+    dimensions are flattened and projected `chunksize` rows at a time with
+    `iter_project_pcs`.
+    
+    Parameters
+    ----------
+    z : array_like, float
+        standardized data of shape [..., p], e.g. [member x lead x p];
+        NaNs mark missing points
+    evecs : array_like, float
+        pxk matrix of eigenvectors (columns)
+    npcs : scalar, int, optional
+        number of pcs to return. Defaults to all k
+    weights : array_like, float, optional
+        weights of size [p] applied to the data before projection
+    chunksize : scalar, int, optional
+        number of fields projected per matrix multiplication. Default: 4096
+        
+    Returns
+    -------
+    pcs : array_like, float
+        principal components of shape [npcs, ...]; for a 2d [n x p] input
+        this equals `calc_pcs(z, evecs, npcs)`
+    
+    """
+    z = np.asarray(z)
+    if z.shape[-1] != evecs.shape[0]:
+        raise ValueError("z must have {0} points in the last dimension "
+                         "(rows of evecs), got {1}".format(evecs.shape[0], z.shape[-1]))
+    batch_shape = z.shape[:-1]
+    nvar = z.shape[-1]
+    z = z.reshape(-1, nvar)
+    nrows = z.shape[0]
+    if npcs is None:
+        npcs = evecs.shape[1]
+    
+    chunks = (z[i:i+chunksize] for i in range(0, nrows, chunksize))
+    # Floating point even for integer input: masked rows are NaN
+    pcs = np.empty((npcs, nrows), dtype=np.result_type(z, evecs, float))
+    for i, tmp in zip(range(0, nrows, chunksize),
+                      iter_project_pcs(chunks, evecs, npcs, weights)):
+        pcs[:, i:i+chunksize] = tmp
+    
+    return pcs.reshape((npcs,) + batch_shape)
+
+
 def loadings(evals, evecs, neofs):
     """Calculate loadings matrix
     
@@ -120,7 +249,46 @@ def loadings(evals, evecs, neofs):
     return loadings
 
 
-def calc_eofs_svd(z, neofs):
+def _svd(z, k, method='full', oversample=10, n_iter=4, random_state=None):
+    """Leading k singular triplets of z, computed with the requested solver.
+
+    Returns U [n x k], S [k] and Vt [k x p] with S in descending order.
+    """
+    if method == 'full':
+        U, S, Vt = np.linalg.svd(z, full_matrices=False)
+        return U[:, 0:k], S[0:k], Vt[0:k, :]
+
+    kmax = min(z.shape)
+    if k > kmax:
+        raise ValueError("neofs must be <= min(n, p) = {0}".format(kmax))
+
+    if method == 'truncated':
+        # Lanczos bidiagonalization (ARPACK); svds requires k < min(n, p)
+        if k == kmax:
+            return _svd(z, k, method='full')
+        from scipy.sparse.linalg import svds
+        U, S, Vt = svds(z, k=k)
+        idx = np.argsort(S)[::-1]
+        return U[:, idx], S[idx], Vt[idx, :]
+
+    if method == 'randomized':
+        # Randomized range finder (Halko et al. 2011, Alg. 4.4)
+        rng = np.random.default_rng(random_state)
+        l = min(k + oversample, kmax)
+        Q = z @ rng.standard_normal((z.shape[1], l)).astype(z.dtype, copy=False)
+        Q, _ = np.linalg.qr(Q)
+        for i in range(n_iter):
+            Q, _ = np.linalg.qr(z.T @ Q)
+            Q, _ = np.linalg.qr(z @ Q)
+        # SVD of the small [l x p] projection
+        Ub, S, Vt = np.linalg.svd(Q.T @ z, full_matrices=False)
+        U = Q @ Ub
+        return U[:, 0:k], S[0:k], Vt[0:k, :]
+
+    raise ValueError("method must be one of 'full', 'truncated', 'randomized'")
+
+
+def calc_eofs_svd(z, neofs, method='full', oversample=10, n_iter=4, random_state=None):
     """Singular value decomposition of data matrix
     
     Parameters
@@ -133,20 +301,49 @@ def calc_eofs_svd(z, neofs):
     neofs : scalar, int
         number of eofs to return (used in loadings and pcs calculation)
         
+    method : {'full', 'truncated', 'randomized'}, optional
+        SVD solver. 'full' computes every singular triplet with
+        np.linalg.svd; 'truncated' computes only the leading `neofs`
+        triplets with Lanczos iteration (scipy.sparse.linalg.svds);
+        'randomized' uses a randomized range finder. Default: 'full'
+        
+    oversample : scalar, int, optional
+        extra random vectors used by the randomized solver. Default: 10
+        
+    n_iter : scalar, int, optional
+        power iterations used by the randomized solver; increase when the
+        singular values decay slowly. Default: 4
+        
+    random_state : int, optional
+        seed for the randomized solver
+        
     Returns
     -------
     evals : array_like, float
-        vector of eigenvalues of size [p]
+        vector of eigenvalues of size [min(n, p)] ([neofs] for the
+        'truncated' and 'randomized' solvers)
     evecs : array_like, float
-        array of eigenvectors (columns); size [p x p]
+        array of eigenvectors (columns); size [p x min(n, p)]
+        ([p x neofs] for the 'truncated' and 'randomized' solvers)
     loadings : array_like, float
         loadings matrix
     pcs : array_like, float
         principal components
+        
+    Notes
+    -----
+    The truncated solvers do not return the trailing eigenvalues, so pass
+    ``total=total_variance(z)`` to `exp_variance` and `north_test`.
     
     """    
+    if method == 'full':
+        k = min(z.shape)
+    else:
+        k = neofs
+        
     # Singular Value Decomposition of z
-    U, S, Vt = np.linalg.svd(z)
+    U, S, Vt = _svd(z, k, method=method, oversample=oversample,
+                    n_iter=n_iter, random_state=random_state)
     ntot = z.shape[0]
 
     # Compute eigenvalues
@@ -165,7 +362,274 @@ def calc_eofs_svd(z, neofs):
     return evals, evecs, loadings, pcs
 
 
-def exp_variance(evals, neofs=None):
+def svd_accuracy(z, neofs, methods=('truncated', 'randomized'), **kwargs):
+    """Accuracy of the truncated SVD solvers against the full solver
+    
+    Intended for small problems where the full decomposition is affordable.
+    
+    Parameters
+    ----------
+    z : array_like, float
+        2d array of standardized data values of size [n x p]
+    neofs : scalar, int
+        number of leading eofs to compare
+    methods : sequence of str, optional
+        solvers to compare against method='full'
+    **kwargs
+        passed to `calc_eofs_svd` (e.g. oversample, n_iter, random_state)
+        
+    Returns
+    -------
+    report : dict
+        for each method, a dict with the maximum relative eigenvalue error
+        (`evals_relerr`), the largest principal angle in degrees between the
+        leading eigenvector subspaces (`max_angle`), and the largest
+        per-mode angle between matching eigenvectors (`mode_angles`)
+    
+    """
+    evals0, evecs0, _, _ = calc_eofs_svd(z, neofs, method='full')
+    evals0 = evals0[0:neofs]
+    evecs0 = evecs0[:, 0:neofs]
+    
+    report = {}
+    for method in methods:
+        evals, evecs, _, _ = calc_eofs_svd(z, neofs, method=method, **kwargs)
+        report[method] = _compare_modes(evals0, evecs0, evals[0:neofs],
+                                        evecs[:, 0:neofs])
+        
+    return report
+
+
+def _compare_modes(evals0, evecs0, evals, evecs):
+    """Eigenvalue and eigenvector errors of (evals, evecs) against a reference."""
+    relerr = np.abs(evals - evals0) / evals0
+    # principal angles between the two subspaces
+    cosines = np.linalg.svd(evecs0.T @ evecs, compute_uv=False)
+    max_angle = np.rad2deg(np.arccos(np.clip(cosines.min(), -1., 1.)))
+    # angle between matching modes (sign-insensitive)
+    dots = np.abs(np.sum(evecs0 * evecs, axis=0))
+    mode_angles = np.rad2deg(np.arccos(np.clip(dots, -1., 1.)))
+    
+    return {'evals_relerr': relerr.max(),
+            'max_angle': max_angle,
+            'mode_angles': mode_angles}
+
+
+def total_variance(z):
+    """Total variance of the data matrix
+    
+    Equal to the sum of all eigenvalues of the covariance matrix, without
+    computing them; use with the truncated solvers in `calc_eofs_svd`.
+    
+    Parameters
+    ----------
+    z : array_like, float
+        2d array of standardized data values of size [n x p]
+        
+    Returns
+    -------
+    total : scalar, float
+        trace of the covariance matrix
+    
+    """
+    ntot = z.shape[0]
+    total = np.sum(z * z) / (ntot - 1.)
+    
+    return total
+
+
+def calc_eofs_xarray(data, neofs, time_dim='time', oversample=10, n_iter=4,
+                     random_state=None):
+    """EOF decomposition of a (chunked) xarray DataArray
+    
+    Out-of-core counterpart of `calc_eofs_svd`. When `data` is backed by a
+    dask array the leading modes are found with dask's randomized SVD
+    (dask.array.linalg.svd_compressed), which works block by block across
+    the workers and never loads the full [n x p] matrix into memory.
+    
+    Parameters
+    ----------
+    data : xarray.DataArray
+        standardized anomalies with a time dimension and one or more
+        spatial dimensions, e.g. (time, lat, lon)
+    neofs : scalar, int
+        number of eofs to compute
+    time_dim : str, optional
+        name of the time (observation) dimension. Default: 'time'
+    oversample : scalar, int, optional
+        extra random vectors used by the randomized solver. Default: 10
+    n_iter : scalar, int, optional
+        power iterations used by the randomized solver. Default: 4
+    random_state : int, optional
+        seed for the randomized solver
+        
+    Returns
+    -------
+    evals : xarray.DataArray
+        eigenvalues, dims (mode); attrs['total_variance'] holds the total
+        variance for use with `exp_variance` and `north_test`
+    evecs : xarray.DataArray
+        eigenvectors mapped back to the grid, dims (mode, lat, lon)
+    loadings : xarray.DataArray
+        loadings mapped back to the grid, dims (mode, lat, lon)
+    pcs : xarray.DataArray
+        principal components, dims (mode, time)
+        
+    Example
+    -------
+    era = xr.open_mfdataset(files, chunks={'time': 365})
+    evals, evecs, loadings, pcs = calc_eofs_xarray(era.z_anom, 4)
+    pct = exp_variance(evals, total=evals.attrs['total_variance'])
+    
+    """
+    import xarray as xr
+    
+    spatial_dims = [d for d in data.dims if d != time_dim]
+    data = data.transpose(time_dim, *spatial_dims)
+    ntot = data.sizes[time_dim]
+    grid_shape = tuple(data.sizes[d] for d in spatial_dims)
+    z = data.data.reshape(ntot, -1)
+    
+    if hasattr(z, 'dask'):
+        import dask
+        import dask.array as dsa
+        U, S, Vt = dsa.linalg.svd_compressed(z, neofs, n_power_iter=n_iter,
+                                             n_oversamples=oversample,
+                                             seed=random_state)
+        ssq = (z * z).sum()
+        U, S, Vt, ssq = dask.compute(U, S, Vt, ssq)
+    else:
+        U, S, Vt = _svd(z, neofs, method='randomized', oversample=oversample,
+                        n_iter=n_iter, random_state=random_state)
+        ssq = np.sum(z * z)
+    
+    # Compute eigenvalues, eigenvectors, loadings and pcs
+    evals = S**2.0 / (ntot-1)
+    evecs = Vt.reshape((neofs,) + grid_shape)
+    loadings = evecs * (S / np.sqrt(ntot-1.0)).reshape((neofs,) + (1,)*len(grid_shape))
+    pcs = (U * S).T
+    
+    # Label the results
+    mode = np.arange(1, neofs+1)
+    grid_coords = {d: data[d] for d in spatial_dims if d in data.coords}
+    evals = xr.DataArray(evals, dims=('mode',), coords={'mode': mode},
+                         name='evals',
+                         attrs={'total_variance': ssq / (ntot-1.)})
+    evecs = xr.DataArray(evecs, dims=['mode'] + spatial_dims,
+                         coords=dict(grid_coords, mode=mode), name='evecs')
+    loadings = xr.DataArray(loadings, dims=['mode'] + spatial_dims,
+                            coords=dict(grid_coords, mode=mode), name='loadings')
+    time_coords = {time_dim: data[time_dim]} if time_dim in data.coords else {}
+    pcs = xr.DataArray(pcs, dims=('mode', time_dim),
+                       coords=dict(time_coords, mode=mode), name='pcs')
+    
+    return evals, evecs, loadings, pcs
+
+
+def combined_eofs(fields, neofs, lags=1, weights=None, normalize=True):
+    """Combined and extended EOFs of several fields
+    
+    Decomposes the block-structured matrix [z1(t) ... z1(t+L-1), z2(t) ...]
+    built from each field and its L-1 time-lagged copies (extended EOFs /
+    multichannel SSA). When the matrix is wide (m smaller than the number
+    of columns) it is not formed: the lagged copies are views into the
+    input arrays and only the [m x m] temporal covariance matrix is
+    accumulated block by block, as in `calc_eofs` when n < p. A tall
+    matrix is smaller than that covariance and is decomposed directly
+    with an SVD.
+    
+    Parameters
+    ----------
+    fields : list of array_like, float
+        standardized anomalies of each field, each of size [n x p_i]
+        (e.g. z500, SLP and u850 on their own grids)
+    neofs : scalar, int
+        number of eofs to return
+    lags : scalar, int, optional
+        embedding window L; 1 gives combined EOFs. Default: 1
+    weights : list of array_like, float, optional
+        weights of size [p_i] for each field (e.g. `spatial_weights` on the
+        flattened grid); None entries leave a field unweighted
+    normalize : bool, optional
+        scale each field by the square root of its total variance so that
+        every field contributes equally; fields with zero variance are
+        left as they are. Default: True
+        
+    Returns
+    -------
+    evals : array_like, float
+        vector of eigenvalues of size [m], m = n - lags + 1
+    evecs : list of array_like, float
+        eigenvectors of each field, size [p_i x neofs]
+        ([lags x p_i x neofs] when lags > 1)
+    pcs : array_like, float
+        principal components of size [neofs x m]
+    
+    """
+    ntot = fields[0].shape[0]
+    m = ntot - lags + 1
+    if weights is None:
+        weights = [None] * len(fields)
+    
+    # Weight and normalize each field (one copy per field, not per lag)
+    scaled = []
+    for z, w in zip(fields, weights):
+        if z.shape[0] != ntot:
+            raise ValueError("all fields must have the same number of time steps")
+        if w is not None:
+            z = z * w
+        if normalize:
+            total = total_variance(z)
+            if total > 0:
+                z = z / np.sqrt(total)
+        scaled.append(z)
+    
+    ncols = lags * sum(z.shape[1] for z in scaled)
+    if neofs > min(m, ncols):
+        raise ValueError("neofs must be <= min(m, columns) = {0}".format(min(m, ncols)))
+    
+    if ncols < m:
+        # Tall matrix: the lagged copies are smaller than the covariance
+        Z = np.hstack([z[l:l+m] for z in scaled for l in range(lags)])
+        U, S, Vt = np.linalg.svd(Z, full_matrices=False)
+        evals = np.zeros(m)
+        evals[0:S.shape[0]] = S**2.0 / (m - 1.)
+        pcs = (U[:, 0:neofs] * S[0:neofs]).T
+        evecs = []
+        start = 0
+        for z in scaled:
+            p = z.shape[1]
+            tmp = Vt[0:neofs, start:start+lags*p].T.reshape(lags, p, neofs)
+            evecs.append(tmp[0] if lags == 1 else tmp)
+            start += lags * p
+        return evals, evecs, pcs
+    
+    # Accumulate the temporal covariance matrix over fields and lags;
+    # z[l:l+m] is a view, so the lagged copies are never materialized
+    G = np.zeros((m, m))
+    for z in scaled:
+        for l in range(lags):
+            G += np.matmul(z[l:l+m], z[l:l+m].T)
+    G /= (m - 1.)
+    
+    evals, u = np.linalg.eigh(G)
+    evals = np.clip(evals[::-1], 0., None)
+    u = u[:, ::-1][:, 0:neofs]
+    
+    # Map back to the eigenvectors of each field and lag; modes without
+    # variance (rank-deficient data) get zero eigenvectors
+    S = np.sqrt((m - 1.) * evals[0:neofs])
+    pcs = (u * S).T
+    Sinv = np.divide(1., S, out=np.zeros_like(S), where=S > 0)
+    evecs = []
+    for z in scaled:
+        tmp = np.stack([np.matmul(z[l:l+m].T, u) * Sinv for l in range(lags)])
+        evecs.append(tmp[0] if lags == 1 else tmp)
+    
+    return evals, evecs, pcs
+
+
+def exp_variance(evals, neofs=None, total=None):
     """Explained variance of EOFs
     
     Calculates the percent of the total variance explained by each EOF.
@@ -177,6 +641,9 @@ def exp_variance(evals, neofs=None):
     neofs : scalar, int
         Number of eigenvectors to return the percent variance for.
         Defaults to all eigenvalues.
+    total : scalar, float, optional
+        Total variance. Defaults to the sum of `evals`; pass
+        `total_variance(z)` when `evals` is truncated.
     
     Returns
     -------
@@ -184,13 +651,15 @@ def exp_variance(evals, neofs=None):
         Percent variances for each EOF
         
     """    
+    if total is None:
+        total = np.sum(evals)
     slicer = slice(0, neofs)
-    pct_var = evals[slicer] / np.sum(evals) * 100.
+    pct_var = evals[slicer] / total * 100.
     
     return pct_var
 
 
-def north_test(evals, n):
+def north_test(evals, n, total=None):
     """North Test for separation of eigenvalues
     
     Parameters
@@ -199,6 +668,9 @@ def north_test(evals, n):
         Array of eigenvalues
     n : scalar, float
         number of independent samples
+    total : scalar, float, optional
+        Total variance. Defaults to the sum of `evals`; pass
+        `total_variance(z)` when `evals` is truncated.
         
     Returns
     -------
@@ -206,8 +678,575 @@ def north_test(evals, n):
         Array of errors scaled by the variance fraction (%)
     
     """   
+    if total is None:
+        total = np.sum(evals)
     tmp = evals * np.sqrt(2.0/n)
-    error = tmp / np.sum(evals) * 100
+    error = tmp / total * 100
     
     return error
 
+
+def _varimax(L, gamma=1.0, tol=1e-6, max_iter=500):
+    """Orthogonal rotation matrix maximizing the varimax criterion of L."""
+    nvar, k = L.shape
+    R = np.eye(k)
+    d = 0.
+    for i in range(max_iter):
+        Lr = L @ R
+        # SVD-based update of the whole rotation (Kaiser 1958; Sherin 1966)
+        B = L.T @ (Lr**3 - (gamma / nvar) * Lr * np.sum(Lr**2, axis=0))
+        u, s, vh = np.linalg.svd(B)
+        R = u @ vh
+        d_old, d = d, np.sum(s)
+        if d_old != 0 and d / d_old < 1 + tol:
+            break
+            
+    return R
+
+
+def rotate(loadings, pcs, evals, method='varimax', normalize=True, power=4,
+           gamma=1.0, tol=1e-6, max_iter=500, total=None):
+    """Rotated EOFs (varimax or promax)
+    
+    Rotates the loadings matrix from `loadings` or `calc_eofs_svd` with
+    matrix operations only, and applies the same rotation to the pcs.
+    
+    Parameters
+    ----------
+    loadings : array_like, float
+        loadings matrix [p x k]
+    pcs : array_like, float
+        principal components [k x n]
+    evals : array_like, float
+        vector of eigenvalues (at least the leading k)
+    method : {'varimax', 'promax'}, optional
+        orthogonal (varimax) or oblique (promax) rotation. Default: 'varimax'
+    normalize : bool, optional
+        Kaiser normalization of the rows before rotating. Default: True
+    power : scalar, int, optional
+        promax exponent. Default: 4
+    gamma : scalar, float, optional
+        orthomax parameter; 1 is varimax, 0 quartimax. Default: 1
+    tol : scalar, float, optional
+        relative convergence tolerance of the varimax criterion. Default: 1e-6
+    max_iter : scalar, int, optional
+        maximum number of varimax iterations. Default: 500
+    total : scalar, float, optional
+        total variance of the data. Default: sum of `evals`; pass
+        `total_variance(z)` when `evals` is truncated.
+        
+    Returns
+    -------
+    rot_loadings : array_like, float
+        rotated loadings matrix [p x k]
+    rot_pcs : array_like, float
+        rotated pcs [k x n], scaled to unit variance
+    pct_var : array_like, float
+        percent of the total variance explained by each rotated eof
+        (same units as `exp_variance`)
+    
+    """
+    k = loadings.shape[1]
+    
+    if normalize:
+        h = np.sqrt(np.sum(loadings**2, axis=1, keepdims=True))
+        h[h == 0] = 1.
+        L = loadings / h
+    else:
+        L = loadings
+        
+    T = _varimax(L, gamma=gamma, tol=tol, max_iter=max_iter)
+    
+    if method == 'promax':
+        Lr = L @ T
+        # Least-squares fit of the varimax solution to its powered target
+        P = Lr * np.abs(Lr)**(power - 1)
+        U = np.linalg.lstsq(Lr, P, rcond=None)[0]
+        U = U * np.sqrt(np.diag(np.linalg.inv(U.T @ U)))
+        T = T @ U
+    elif method != 'varimax':
+        raise ValueError("method must be 'varimax' or 'promax'")
+    
+    rot_loadings = L @ T
+    if normalize:
+        rot_loadings = rot_loadings * h
+        
+    # Unit-variance pcs rotate with the inverse transpose of T
+    scores = pcs[0:k].T / np.sqrt(evals[0:k])
+    rot_pcs = (scores @ np.linalg.inv(T).T).T
+    
+    if total is None:
+        total = np.sum(evals)
+    pct_var = np.sum(rot_loadings**2, axis=0) / total * 100.
+    
+    return rot_loadings, rot_pcs, pct_var
+
+
+def _block_indices(rng, n, block):
+    """Moving-block bootstrap sample of the time indices 0..n-1."""
+    nblocks = -(-n // block)
+    starts = rng.integers(0, n - block + 1, size=nblocks)
+    idx = starts[:, np.newaxis] + np.arange(block)
+    
+    return idx.ravel()[0:n]
+
+
+# Data matrix shared with the worker processes of the Monte Carlo tests
+_MC_DATA = None
+
+
+def _mc_init(z):
+    global _MC_DATA
+    _MC_DATA = z
+
+
+def _mc_replicate(args):
+    """One bootstrap or permutation replicate of the leading modes."""
+    kind, seed, neofs, block, method, patterns = args
+    z = _MC_DATA
+    rng = np.random.default_rng(seed)
+    ntot, nvar = z.shape
+    
+    if kind == 'bootstrap':
+        zr = z[_block_indices(rng, ntot, block)]
+        zr = zr - zr.mean(axis=0)
+    else:
+        # Scramble each column in time to destroy the spatial covariance;
+        # random circular shifts keep the autocorrelation when block > 1
+        if block > 1:
+            shifts = rng.integers(0, ntot, size=nvar)
+            idx = (np.arange(ntot)[:, np.newaxis] + shifts) % ntot
+        else:
+            idx = rng.permuted(np.broadcast_to(np.arange(ntot)[:, np.newaxis],
+                                               (ntot, nvar)), axis=0)
+        zr = np.take_along_axis(z, idx, axis=0)
+        
+    U, S, Vt = _svd(zr, neofs, method=method, random_state=rng)
+    pct_var = exp_variance(S**2.0 / (ntot-1), total=total_variance(zr))
+    
+    if patterns:
+        return pct_var, Vt.T
+    return pct_var, None
+
+
+def _run_replicates(z, kind, neofs, nrep, block, method, patterns, nproc, seed):
+    """Run replicates serially (nproc=1) or in a process pool."""
+    seeds = np.random.SeedSequence(seed).spawn(nrep)
+    tasks = [(kind, s, neofs, block, method, patterns) for s in seeds]
+    
+    if nproc == 1:
+        _mc_init(z)
+        results = [_mc_replicate(t) for t in tasks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        nproc = nproc or os.cpu_count()
+        chunksize = max(1, nrep // (4 * nproc))
+        with ProcessPoolExecutor(max_workers=nproc, initializer=_mc_init,
+                                 initargs=(z,)) as pool:
+            results = list(pool.map(_mc_replicate, tasks, chunksize=chunksize))
+            
+    return results
+
+
+def bootstrap_test(z, neofs, nboot=200, block=1, percentiles=(2.5, 97.5),
+                   method='truncated', patterns=False, nproc=None, seed=None):
+    """Bootstrap confidence intervals for the explained variance of EOFs
+    
+    Monte Carlo counterpart of `north_test`: the rows (time steps) of `z`
+    are resampled with replacement and the leading `neofs` modes are
+    recomputed for each replicate with the truncated solver of
+    `calc_eofs_svd`. Replicates run in a process pool and are reproducible
+    for a given `seed`, independent of `nproc`.
+    
+    Parameters
+    ----------
+    z : array_like, float
+        2d array of standardized data values of size [n x p]
+    neofs : scalar, int
+        number of eofs to test
+    nboot : scalar, int, optional
+        number of bootstrap replicates. Default: 200
+    block : scalar, int, optional
+        block length of the moving-block bootstrap; use a block longer
+        than the decorrelation time for autocorrelated series. Default: 1
+    percentiles : sequence of float, optional
+        percentiles of the confidence band. Default: (2.5, 97.5)
+    method : {'truncated', 'full', 'randomized'}, optional
+        SVD solver for each replicate. 'randomized' is faster but biased low
+        for the flat spectra of the replicates. Default: 'truncated'
+    patterns : bool, optional
+        also return percentile bands of the eigenvectors. Default: False
+    nproc : scalar, int, optional
+        number of worker processes; 1 runs serially. Default: os.cpu_count()
+    seed : int, optional
+        seed for the resampling
+        
+    Returns
+    -------
+    error : array_like, float
+        bootstrap standard error of the variance fraction (%) of each eof,
+        comparable to `north_test`
+    bands : array_like, float
+        percentiles of the variance fraction (%), size [len(percentiles) x neofs]
+    pattern_bands : array_like, float
+        percentiles of the eigenvectors, size [len(percentiles) x p x neofs];
+        only returned if `patterns` is True. Replicate eigenvectors are
+        sign-aligned with the eigenvectors of `z`.
+    
+    """
+    results = _run_replicates(z, 'bootstrap', neofs, nboot, block, method,
+                              patterns, nproc, seed)
+    pct_var = np.array([r[0] for r in results])
+    error = pct_var.std(axis=0, ddof=1)
+    bands = np.percentile(pct_var, percentiles, axis=0)
+    
+    if not patterns:
+        return error, bands
+    
+    _, _, Vt = _svd(z, neofs, method=method, random_state=seed)
+    evecs = np.array([r[1] for r in results])
+    signs = np.sign(np.sum(evecs * Vt.T, axis=1, keepdims=True))
+    signs[signs == 0] = 1.
+    pattern_bands = np.percentile(evecs * signs, percentiles, axis=0)
+    
+    return error, bands, pattern_bands
+
+
+def rule_n_test(z, neofs, nperm=200, block=1, percentiles=(5., 95.),
+                method='truncated', nproc=None, seed=None):
+    """Rule N significance test for the explained variance of EOFs
+    
+    Compares the variance fraction of each eof with its distribution for
+    data without spatial covariance, obtained by scrambling each column of
+    `z` in time (Preisendorfer's Rule N). Replicates run in a process pool
+    and are reproducible for a given `seed`.
+    
+    Parameters
+    ----------
+    z : array_like, float
+        2d array of standardized data values of size [n x p]
+    neofs : scalar, int
+        number of eofs to test
+    nperm : scalar, int, optional
+        number of permutation replicates. Default: 200
+    block : scalar, int, optional
+        if > 1, columns are scrambled by random circular shifts, which keeps
+        their autocorrelation, instead of by permutation. Default: 1
+    percentiles : sequence of float, optional
+        percentiles of the null distribution to return. Default: (5, 95)
+    method : {'truncated', 'full', 'randomized'}, optional
+        SVD solver for each replicate. 'randomized' is faster but biased low
+        for the flat spectra of the replicates. Default: 'truncated'
+    nproc : scalar, int, optional
+        number of worker processes; 1 runs serially. Default: os.cpu_count()
+    seed : int, optional
+        seed for the permutations
+        
+    Returns
+    -------
+    pvals : array_like, float
+        probability of a variance fraction at least as large as observed for
+        each eof under the null hypothesis
+    bands : array_like, float
+        percentiles of the null variance fraction (%),
+        size [len(percentiles) x neofs]
+    
+    """
+    U, S, Vt = _svd(z, neofs, method=method, random_state=seed)
+    observed = exp_variance(S**2.0 / (z.shape[0]-1), total=total_variance(z))
+    
+    results = _run_replicates(z, 'permutation', neofs, nperm, block, method,
+                              False, nproc, seed)
+    null = np.array([r[0] for r in results])
+    pvals = (np.sum(null >= observed, axis=0) + 1.) / (nperm + 1.)
+    bands = np.percentile(null, percentiles, axis=0)
+    
+    return pvals, bands
+
+## CLASSES
+
+class IncrementalEOF(object):
+    """Incrementally updated EOFs for data that grows along the time axis
+    
+    Keeps a compact low-rank state (number of samples, running mean and the
+    leading singular values/vectors of the centered data) that is updated
+    with each new batch of observations, so appending a day of data costs
+    time proportional to the batch size instead of a full recompute with
+    `calc_eofs_svd`. The running mean is removed internally, so batches may
+    be raw (weighted) fields rather than anomalies.
+    
+    Parameters
+    ----------
+    neofs : scalar, int
+        number of eofs to report
+    oversample : scalar, int, optional
+        extra modes carried in the state to limit truncation drift.
+        Default: 10
+        
+    Example
+    -------
+    ieof = IncrementalEOF(4)
+    for yr in years:
+        ieof.update(z[yr])          # z[yr] is a [ndays x p] matrix
+    ieof.save('z500_ieof.npz')
+    ieof = IncrementalEOF.load('z500_ieof.npz')
+    ieof.update(z_today)
+    pct = exp_variance(ieof.evals, total=ieof.total)
+    
+    """
+    
+    def __init__(self, neofs, oversample=10):
+        self.neofs = neofs
+        self.oversample = oversample
+        self.n_samples = 0
+        self.mean = None
+        self.singular_values = None
+        self.components = None
+        self.ssq = 0.
+        
+    def update(self, batch):
+        """Add new observations (rows) to the decomposition
+        
+        Parameters
+        ----------
+        batch : array_like, float
+            matrix of new data values [m x p]
+        
+        Returns
+        -------
+        self : IncrementalEOF
+        
+        """
+        batch = np.atleast_2d(np.asarray(batch, dtype=float))
+        nb = batch.shape[0]
+        ntot = self.n_samples + nb
+        batch_mean = batch.mean(axis=0)
+        centered = batch - batch_mean
+        
+        if self.n_samples == 0:
+            new_mean = batch_mean
+            mat = centered
+            ssq = np.sum(centered * centered)
+        else:
+            # Stack the current low-rank state, the centered batch and a
+            # correction row for the shift in the mean (Ross et al. 2008)
+            shift = np.sqrt(self.n_samples * nb / ntot) * (self.mean - batch_mean)
+            new_mean = self.mean + (batch_mean - self.mean) * nb / ntot
+            mat = np.vstack((self.singular_values[:, np.newaxis] * self.components,
+                             centered, shift))
+            ssq = self.ssq + np.sum(centered * centered) + np.sum(shift * shift)
+        
+        U, S, Vt = np.linalg.svd(mat, full_matrices=False)
+        k = min(self.neofs + self.oversample, S.shape[0])
+        
+        self.n_samples = ntot
+        self.mean = new_mean
+        self.singular_values = S[0:k]
+        self.components = Vt[0:k, :]
+        self.ssq = ssq
+        
+        return self
+    
+    def _check_samples(self):
+        if self.n_samples < 2:
+            raise ValueError("IncrementalEOF needs at least 2 samples, got {0}".format(
+                self.n_samples))
+    
+    @property
+    def evals(self):
+        """Vector of the leading eigenvalues of size [neofs]"""
+        self._check_samples()
+        S = self.singular_values[0:self.neofs]
+        return S**2.0 / (self.n_samples - 1)
+    
+    @property
+    def evecs(self):
+        """Array of the leading eigenvectors (columns); size [p x neofs]"""
+        self._check_samples()
+        return self.components[0:self.neofs, :].T
+    
+    @property
+    def loadings(self):
+        """Loadings matrix of size [p x neofs]"""
+        self._check_samples()
+        return loadings(self.evals, self.evecs, self.neofs)
+    
+    @property
+    def total(self):
+        """Total variance of all data seen so far"""
+        self._check_samples()
+        return self.ssq / (self.n_samples - 1.)
+    
+    def pcs(self, z):
+        """Principal components of `z` [n x p] about the running mean"""
+        self._check_samples()
+        return calc_pcs(z - self.mean, self.evecs, self.neofs)
+    
+    def drift(self, z):
+        """Drift diagnostics against a full recompute
+        
+        Parameters
+        ----------
+        z : array_like, float
+            full record of data values [n x p] passed to `update` so far
+            
+        Returns
+        -------
+        report : dict
+            `evals_relerr`, `max_angle` and `mode_angles` as in
+            `svd_accuracy`, plus the maximum absolute difference of the
+            running mean (`mean_abserr`) and the relative error of the total
+            variance (`total_relerr`)
+        
+        """
+        z = np.asarray(z, dtype=float)
+        mean = z.mean(axis=0)
+        za = z - mean
+        evals0, evecs0, _, _ = calc_eofs_svd(za, self.neofs, method='truncated')
+        report = _compare_modes(evals0, evecs0, self.evals, self.evecs)
+        report['mean_abserr'] = np.abs(self.mean - mean).max()
+        total0 = total_variance(za)
+        report['total_relerr'] = abs(self.total - total0) / total0
+        
+        return report
+    
+    def save(self, path):
+        """Write the state to a .npz file"""
+        if self.n_samples == 0:
+            # Empty arrays instead of None (no object arrays in the file)
+            mean, S, components = np.empty(0), np.empty(0), np.empty((0, 0))
+        else:
+            mean, S, components = self.mean, self.singular_values, self.components
+        np.savez(path, neofs=self.neofs, oversample=self.oversample,
+                 n_samples=self.n_samples, mean=mean, singular_values=S,
+                 components=components, ssq=self.ssq)
+        
+    @classmethod
+    def load(cls, path):
+        """Read a state written by `save`"""
+        with np.load(path) as f:
+            obj = cls(int(f['neofs']), oversample=int(f['oversample']))
+            obj.n_samples = int(f['n_samples'])
+            if obj.n_samples > 0:
+                obj.mean = f['mean']
+                obj.singular_values = f['singular_values']
+                obj.components = f['components']
+            obj.ssq = float(f['ssq'])
+            
+        return obj
+
+
+class ValidPoints(object):
+    """Index of the valid (non-missing) grid points of a gridded field
+    
+    Built once from data with missing values (e.g. land points in SST),
+    then used to gather only the valid columns into a contiguous matrix
+    for the decomposition, to compress grid weights and later fields in
+    the same way, and to scatter the EOF patterns back onto the full grid.
+    
+    Parameters
+    ----------
+    z : array_like, float
+        data of shape [n, ...]; the trailing dimensions are the grid
+        (e.g. [time x lat x lon] or [n x p]). A point is valid if it is
+        finite at every time step.
+        
+    Attributes
+    ----------
+    grid_shape : tuple
+        shape of the full grid
+    index : array_like, int
+        flat indices of the valid points
+        
+    Example
+    -------
+    vp = ValidPoints(sst)                            # [time x lat x lon]
+    w = vp.compress_weights(spatial_weights(lats))
+    z = vp.compress(sst) * w
+    evals, evecs, loadings, pcs = calc_eofs_svd(z, 4, method='truncated')
+    eof_maps = vp.expand(evecs)                      # [lat x lon x 4]
+    pcs_new = calc_pcs(vp.compress(sst_new) * w, evecs, 4)
+    
+    """
+    
+    def __init__(self, z):
+        self.grid_shape = tuple(z.shape[1:])
+        mask = np.isfinite(z).all(axis=0)
+        self.index = np.flatnonzero(mask)
+        
+    @property
+    def nvalid(self):
+        """Number of valid grid points"""
+        return self.index.shape[0]
+    
+    def compress(self, z):
+        """Gather the valid points of `z` [..., *grid_shape] into a
+        contiguous float array [..., nvalid]"""
+        z = np.asarray(z)
+        ngrid = len(self.grid_shape)
+        z = z.reshape(z.shape[:z.ndim-ngrid] + (-1,))
+        if not np.issubdtype(z.dtype, np.floating):
+            z = z.astype(float)
+        
+        return np.take(z, self.index, axis=-1)
+    
+    def compress_weights(self, weights):
+        """Compress grid weights to the valid points
+        
+        `weights` is broadcast to the grid; a 1d array matching the first
+        grid dimension (e.g. `spatial_weights(lats)`) is broadcast along
+        the remaining ones.
+        """
+        weights = np.asarray(weights)
+        ngrid = len(self.grid_shape)
+        if weights.ndim == 1 and ngrid > 1:
+            weights = weights.reshape((-1,) + (1,)*(ngrid-1))
+        weights = np.broadcast_to(weights, self.grid_shape).reshape(-1)
+        
+        return weights[self.index]
+    
+    def expand(self, a, axis=0, fill=np.nan):
+        """Scatter `a` back onto the full grid
+        
+        Parameters
+        ----------
+        a : array_like, float
+            array with a dimension of size nvalid at `axis`, e.g. evecs or
+            loadings [nvalid x k]
+        axis : scalar, int, optional
+            axis of `a` holding the valid points. Default: 0
+        fill : scalar, float, optional
+            value at the missing points. Default: NaN
+            
+        Returns
+        -------
+        out : array_like, float
+            array with `axis` replaced by the grid dimensions, e.g.
+            [lat x lon x k]
+        
+        """
+        a = np.asarray(a)
+        axis = axis % a.ndim
+        a = np.moveaxis(a, axis, -1)
+        out = np.full(a.shape[:-1] + (int(np.prod(self.grid_shape)),), fill,
+                      dtype=np.result_type(a.dtype, np.min_scalar_type(fill)))
+        out[..., self.index] = a
+        out = out.reshape(a.shape[:-1] + self.grid_shape)
+        ngrid = len(self.grid_shape)
+        
+        return np.moveaxis(out, list(range(-ngrid, 0)),
+                           list(range(axis, axis+ngrid)))
+    
+    def save(self, path):
+        """Write the index to a .npz file"""
+        np.savez(path, grid_shape=self.grid_shape, index=self.index)
+        
+    @classmethod
+    def load(cls, path):
+        """Read an index written by `save`"""
+        obj = cls.__new__(cls)
+        with np.load(path) as f:
+            obj.grid_shape = tuple(int(i) for i in f['grid_shape'])
+            obj.index = f['index']
+            
+        return obj
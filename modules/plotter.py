@@ -6,20 +6,24 @@ Description: Functions for plotting
 
 
 import os
+import sys
+import io
+import functools
+import pickle
+import hashlib
+import subprocess
+import threading
+import queue
+import time
+import warnings
+from collections import OrderedDict
 import numpy as np
-import pandas as pd
-import xarray as xr
-import netCDF4 as nc
-import matplotlib.pyplot as plt
-import colorsys
+import matplotlib as mpl
 from matplotlib.colors import LinearSegmentedColormap
-import seaborn as sns
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
-from cartopy.mpl.ticker import LongitudeFormatter, LatitudeFormatter
-import matplotlib.ticker as mticker
-import matplotlib.animation as animation
+# pandas, pyplot, matplotlib.animation and cartopy are imported inside the
+# functions that use them, so that importing this module (e.g. in batch
+# workers that only need make_cmap or nice_intervals) stays cheap.
+# See benchmarks/import_benchmark.py.
 
 
 def simple_line_plot(df, varname, title=None, x_label=None,  y_label=None, color='b'):
@@ -47,6 +51,8 @@ def simple_line_plot(df, varname, title=None, x_label=None,  y_label=None, color
         -------
         Line plot of df and variable entered.        
         '''
+    import matplotlib.pyplot as plt
+
     x=df.index
     y=df[varname]
     c=color
@@ -60,7 +66,11 @@ def simple_line_plot(df, varname, title=None, x_label=None,  y_label=None, color
     plt.show()
 
     
-def simple_xarray_contour_map(data, cmap, cflevs=None):
+def simple_xarray_contour_map(data, cmap, cflevs=None, filename='plotfile.png', show=True):
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    import cartopy.crs as ccrs
+
     data = data
     # Set map projection
     mapcrs = ccrs.PlateCarree()  # what we want data to plot as
@@ -86,12 +96,19 @@ def simple_xarray_contour_map(data, cmap, cflevs=None):
                         label=data.attrs['units'], spacing='uniform')
 
     # Save to file
-    plt.savefig('plotfile.png')
+    if filename is not None:
+        plt.savefig(filename)
 
     # Show plot
-    plt.show()
+    if show:
+        plt.show()
     
-def simple_xarray_pcolormesh_map(data, cmap, vmin, vmax):
+def simple_xarray_pcolormesh_map(data, cmap, vmin, vmax, filename='plotfile.png', show=True,
+                                 decimate=False, verbose=False):
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    import cartopy.crs as ccrs
+
     data = data
     # Set map projection
     mapcrs = ccrs.PlateCarree()  # what we want data to plot as
@@ -102,8 +119,16 @@ def simple_xarray_pcolormesh_map(data, cmap, vmin, vmax):
     ax = fig.add_subplot(1, 1, 1, projection=mapcrs)
 
     # Add data
-    p = ax.pcolormesh(data.longitude, data.latitude, data[0].values, transform=datacrs,
+    values, lons, lats = data[0].values, data.longitude.values, data.latitude.values
+    if decimate:
+        how = 'mean' if decimate is True else decimate
+        values, lons, lats, info = decimate_for_display(values, lons, lats, fig.get_size_inches(),
+                                                        fig.dpi, how=how)
+    t0 = time.time()
+    p = ax.pcolormesh(lons, lats, values, transform=datacrs,
                 cmap=cmap, vmin=vmin, vmax=vmax)
+    if decimate and verbose:
+        _print_decimation(info, time.time() - t0)
 
     # Add plot elements
     ax.coastlines()
@@ -117,12 +142,185 @@ def simple_xarray_pcolormesh_map(data, cmap, vmin, vmax):
                         label=data.attrs['units'])
 
     # Save to file
-    plt.savefig('plotfile.png')
+    if filename is not None:
+        plt.savefig(filename)
 
     # Show plot
-    plt.show()
+    if show:
+        plt.show()
+    
+def _batch_task(spec):
+    '''Select the 2d field of one render_batch spec (in the main process).'''
+    import pandas as pd
+
+    data = spec['data']
+    if 'variable' in spec:
+        data = data[spec['variable']]
+    if 'time' in spec:
+        data = data.sel(time=spec['time'])
+    title = data.attrs.get('long_name', data.name) + ' (' + data.attrs.get('units', '') + ')'
+    if 'time' in data.coords and data.time.size == 1:
+        t0 = pd.to_datetime(str(data.time.values)).strftime("%Y-%m-%d %H:%M")
+        title = title + ' at ' + t0
+    
+    extent = spec.get('extent')
+    return {'output': spec['output'],
+            'values': np.asarray(data.values),
+            'lons': np.asarray(data.longitude),
+            'lats': np.asarray(data.latitude),
+            'units': data.attrs.get('units', ''),
+            'title': spec.get('title', title),
+            'kind': spec.get('kind', 'contourf'),
+            'extent': None if extent is None else tuple(extent),
+            'cmap': spec.get('cmap'),
+            'levels': spec.get('levels'),
+            'vmin': spec.get('vmin'),
+            'vmax': spec.get('vmax'),
+            'figsize': tuple(spec.get('figsize', (7, 5))),
+            'dpi': spec.get('dpi', 150)}
+
+
+# Figure templates (basemap already drawn) reused by _render_task
+_TEMPLATES = {}
+
+
+def _template(extent, figsize):
+    '''Figure, map axes and colorbar axes for a given extent and figure size.'''
+    import cartopy.crs as ccrs
+
+    key = (extent, figsize)
+    if key not in _TEMPLATES:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        # Non-interactive figure that does not touch pyplot state
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        mapcrs = ccrs.PlateCarree()
+        ax = fig.add_axes([0.05, 0.2, 0.9, 0.7], projection=mapcrs)
+        cax = fig.add_axes([0.125, 0.1, 0.75, 0.03])
+        if extent is None:
+            ax.set_global()
+        else:
+            ax.set_extent(extent, crs=mapcrs)
+        ax.coastlines()
+        ax.gridlines()
+        _TEMPLATES[key] = (fig, ax, cax)
+        
+    return _TEMPLATES[key]
+
+
+def _drop_templates(key=None):
+    '''Clear and forget the template of `key`, or all templates.'''
+    keys = list(_TEMPLATES) if key is None else [key]
+    for k in keys:
+        if k in _TEMPLATES:
+            # Agg figures outside pyplot: clearing releases the artists
+            _TEMPLATES.pop(k)[0].clear()
+
+
+def _render_task(task):
+    '''Render one map for render_batch and return its manifest entry.'''
+    import cartopy.crs as ccrs
+
+    t0 = time.time()
+    entry = {'output': task['output']}
+    if 'error' in task:
+        return dict(entry, status=task['error'], seconds=0.)
+    try:
+        fig, ax, cax = _template(task['extent'], task['figsize'])
+        datacrs = ccrs.PlateCarree()
+        if task['kind'] == 'pcolormesh':
+            p = ax.pcolormesh(task['lons'], task['lats'], task['values'], transform=datacrs,
+                              cmap=task['cmap'], vmin=task['vmin'], vmax=task['vmax'])
+            artists = [p]
+        else:
+            p = ax.contourf(task['lons'], task['lats'], task['values'], transform=datacrs,
+                            cmap=task['cmap'], levels=task['levels'], extend='both')
+            artists = _contour_artists(p)
+        title = ax.set_title(task['title'])
+        fig.colorbar(p, cax=cax, orientation='horizontal', label=task['units'])
+        
+        outdir = os.path.dirname(task['output'])
+        if outdir:
+            os.makedirs(outdir, exist_ok=True)
+        fig.savefig(task['output'], dpi=task['dpi'])
+        
+        # Reset the template for the next map
+        for a in artists:
+            a.remove()
+        title.set_text('')
+        cax.clear()
+        entry['status'] = 'ok'
+    except Exception as err:
+        # The template may still hold this map's artists: build a fresh one next time
+        _drop_templates((task['extent'], task['figsize']))
+        entry['status'] = 'error: {0!r}'.format(err)
+    entry['seconds'] = time.time() - t0
     
-def simple_contour_plot (data, lons, lats, datacrs= ccrs.PlateCarree(), mapcrs= ccrs.PlateCarree(), title = None, data_units = '', sequential = False, diverging = False, colormap='', cbar_orientation = 'horizontal'):
+    return entry
+
+
+def render_batch(specs, nproc=None):
+    '''Render many maps (variables x time steps x domains) in one call.
+    
+    Each spec is rendered headless on an Agg canvas in a pool of worker
+    processes. Workers keep one figure template (map axes with coastlines
+    and gridlines, colorbar axes) per extent and figure size and only swap
+    the data, title and colorbar between maps, writing every image to its
+    own output file.
+    
+        Parameters
+        ----------
+        specs: list of dict
+            One dict per image with keys
+                'data': xarray DataArray or Dataset with latitude/longitude (and time)
+                'output': output file path
+                'variable': variable name, optional (required for a Dataset)
+                'time': time label selected with .sel(time=...), optional
+                'extent': [lonmin, lonmax, latmin, latmax], optional (default: global)
+                'kind': 'contourf' (default) or 'pcolormesh'
+                'cmap', 'levels' (contourf), 'vmin', 'vmax' (pcolormesh), optional
+                'title', 'figsize' (default (7, 5)), 'dpi' (default 150), optional
+        nproc: int, optional
+            Number of worker processes; 1 renders in this process (and
+            frees the templates at the end). Default: os.cpu_count()
+            
+        Returns
+        -------
+        manifest: list of dict
+            One entry per spec, in order, with 'output', 'status' ('ok' or the
+            error) and 'seconds' (render time of that image)
+            
+        Example
+        -------
+        specs = [{'data': era, 'variable': 'z', 'time': t, 'cmap': 'viridis',
+                  'output': 'maps/z_{0:%Y%m%d%H}.png'.format(pd.Timestamp(t))}
+                 for t in era.time.values]
+        manifest = render_batch(specs, nproc=8)
+        '''
+    # Slice the data here so workers only receive the 2d fields
+    tasks = []
+    for spec in specs:
+        try:
+            tasks.append(_batch_task(spec))
+        except Exception as err:
+            tasks.append({'output': spec.get('output'),
+                          'error': 'error: {0!r}'.format(err)})
+    
+    if nproc == 1:
+        try:
+            return [_render_task(task) for task in tasks]
+        finally:
+            _drop_templates()
+    
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        manifest = list(pool.map(_render_task, tasks))
+        
+    return manifest
+
+
+def simple_contour_plot (data, lons, lats, datacrs=None, mapcrs=None, title = None, data_units = '', sequential = False, diverging = False, colormap='', cbar_orientation = 'horizontal', decimate=False, verbose=False):
 
     '''A plug and chug quick contour plot for spatial data.
     
@@ -135,12 +333,12 @@ def simple_contour_plot (data, lons, lats, datacrs= ccrs.PlateCarree(), mapcrs=
         lats: float
         
         datacrs: string, optional
-            What projection data comes in.
+            What projection data comes in. Default: ccrs.PlateCarree()
             Note: If data comes in lons & lats, means that it is PlateCarree().
             https://scitools.org.uk/cartopy/docs/latest/crs/projections.html#cartopy-projections
             
         mapcrs: string, optional
-            What projection you want output to be in.
+            What projection you want output to be in. Default: ccrs.PlateCarree()
             
         title: string, optional
         
@@ -153,12 +351,27 @@ def simple_contour_plot (data, lons, lats, datacrs= ccrs.PlateCarree(), mapcrs=
         cbar_orientation: string, optional
             Color bar orientation, either horizonatal or vertical.
             
+        decimate: bool or string, optional
+            Coarsen the field to the pixel density of the figure before
+            plotting (see decimate_for_display). True uses block means; 'max',
+            'min' or 'extreme' preserve the block extremes. Default: False
+            
+        verbose: bool, optional
+            Print the decimation factor and plotting time. Default: False
+            
         Returns
         -------
         Contour plot of data within specified lat and lon.
     
         '''
-#     clevs = _nice_intervals(data, 10)
+    import matplotlib.pyplot as plt
+    import cartopy.crs as ccrs
+
+    if datacrs is None:
+        datacrs = ccrs.PlateCarree()
+    if mapcrs is None:
+        mapcrs = ccrs.PlateCarree()
+#     clevs = nice_intervals(data, 10)
     fig = plt.figure(figsize=(7, 5))
     ax = fig.add_subplot(1, 1, 1, projection=mapcrs)
     
@@ -171,10 +384,17 @@ def simple_contour_plot (data, lons, lats, datacrs= ccrs.PlateCarree(), mapcrs=
     else: 
         colobar = 'YlOrRd'
 
+    if decimate:
+        how = 'mean' if decimate is True else decimate
+        data, lons, lats, info = decimate_for_display(data, lons, lats, fig.get_size_inches(),
+                                                      fig.dpi, how=how)
+    t0 = time.time()
     p = ax.contourf(lons, lats, data, transform=datacrs,
                 cmap = colormap, extend='both'
 #                     , levels=clevs
                    )
+    if decimate and verbose:
+        _print_decimation(info, time.time() - t0)
     
     ax.coastlines()
     ax.gridlines()
@@ -187,24 +407,244 @@ def simple_contour_plot (data, lons, lats, datacrs= ccrs.PlateCarree(), mapcrs=
 
 
 
-def _nice_intervals(data, nlevs):
+def _extreme(x, axis=None):
+    '''Value of largest deviation from the mean over `axis` (keeps peaks of either sign).'''
+    if axis is None:
+        axis = tuple(range(x.ndim))
+    x = np.moveaxis(x, axis, tuple(range(-len(axis), 0)))
+    x = x.reshape(x.shape[:x.ndim-len(axis)] + (-1,))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(x, axis=-1, keepdims=True)
+    dev = np.nan_to_num(np.abs(x - mean), nan=-1.)
+    idx = np.argmax(dev, axis=-1)[..., np.newaxis]
+    
+    return np.take_along_axis(x, idx, axis=-1)[..., 0]
+
+
+_REDUCTIONS = {'mean': np.nanmean, 'max': np.nanmax, 'min': np.nanmin, 'extreme': _extreme}
+
+
+def _coarsen(a, fy, fx, how='mean'):
+    '''Block-reduce the last two axes of a numpy or dask array by (fy, fx), trimming the edges.'''
+    reduction = _REDUCTIONS[how]
+    ny, nx = a.shape[-2] // fy, a.shape[-1] // fx
+    if hasattr(a, 'dask'):
+        import dask.array as dsa
+        axes = {a.ndim-2: fy, a.ndim-1: fx}
+        return dsa.coarsen(reduction, a, axes, trim_excess=True)
+    a = np.asarray(a)[..., 0:ny*fy, 0:nx*fx]
+    a = a.reshape(a.shape[:-2] + (ny, fy, nx, fx))
+    with warnings.catch_warnings():
+        # all-NaN blocks stay NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return reduction(a, axis=(-3, -1))
+    
+
+def decimate_for_display(data, lons, lats, figsize, dpi, extent=None, how='mean', oversample=1.):
+    '''Coarsen a gridded field to the pixel density of the output figure.
+    
+    contourf and pcolormesh cost grows with the number of grid cells, so a
+    native 0.25 deg global field (1440x721) drawn on a 7x5 inch, 100 dpi
+    figure mostly draws cells smaller than a pixel. This block-reduces the
+    field so that about `oversample` cells remain per pixel.
+    
+        Parameters
+        ----------
+        data: array (numpy, dask or xarray)
+            Field with latitude and longitude as the last two dimensions
+        lons, lats: array
+            1d (or 2d, e.g. WRF) longitudes and latitudes of the grid
+        figsize: tuple
+            Figure size in inches (width, height)
+        dpi: float
+            Figure resolution
+        extent: list, optional
+            Map extent [lonmin, lonmax, latmin, latmax] for 1d coordinates;
+            only cells inside the extent count toward the density.
+            Default: None (whole grid)
+        how: string, optional
+            Block reduction: 'mean' (default), 'max', 'min', or 'extreme'
+            (the value of largest deviation from the block mean, so peaks of
+            either sign survive)
+        oversample: float, optional
+            Target number of grid cells per pixel. Default: 1
+            
+        Returns
+        -------
+        data, lons, lats: arrays
+            Coarsened field and coordinates (block means)
+        info: dict
+            'factor' (fy, fx), 'cells_in', 'cells_out' and 'reduction'
+            (cells_in / cells_out, the expected render-time saving)
+        '''
+    # Unwrap xarray objects; keep dask arrays lazy
+    values = data.data if hasattr(data, 'dims') else data
+    if not hasattr(values, 'dask'):
+        values = np.asarray(values)
+    lons = np.asarray(lons)
+    lats = np.asarray(lats)
+    ny, nx = values.shape[-2:]
+    
+    # Grid cells that fall inside the map
+    if extent is not None and lons.ndim == 1:
+        cells_x = np.count_nonzero((lons >= extent[0]) & (lons <= extent[1]))
+        cells_y = np.count_nonzero((lats >= extent[2]) & (lats <= extent[3]))
+    else:
+        cells_x, cells_y = nx, ny
+    pixels_x = figsize[0] * dpi * oversample
+    pixels_y = figsize[1] * dpi * oversample
+    fx = max(1, int(cells_x // pixels_x))
+    fy = max(1, int(cells_y // pixels_y))
+    
+    if fx > 1 or fy > 1:
+        values = _coarsen(values, fy, fx, how=how)
+        if lons.ndim == 1:
+            lons = _coarsen(lons[np.newaxis, :], 1, fx)[0]
+            lats = _coarsen(lats[:, np.newaxis], fy, 1)[:, 0]
+        else:
+            lons = _coarsen(lons, fy, fx)
+            lats = _coarsen(lats, fy, fx)
+    
+    cells_out = values.shape[-2] * values.shape[-1]
+    info = {'factor': (fy, fx), 'cells_in': ny * nx, 'cells_out': cells_out,
+            'reduction': ny * nx / float(cells_out)}
+    
+    return values, lons, lats, info
+
+
+def _print_decimation(info, seconds):
+    '''Report the decimation of a plotted field.'''
+    print('Decimated by {0}x{1}: {2} -> {3} cells ({4:.1f}x fewer); '
+          'plotted in {5:.2f} s'.format(info['factor'][0], info['factor'][1],
+                                       info['cells_in'], info['cells_out'],
+                                       info['reduction'], seconds))
+
+
+class _QuantileSketch(object):
+    '''Mergeable log-bucketed histogram for approximate percentiles (DDSketch).
+    
+    Each value x falls in bucket ceil(log_gamma |x|), kept separately for
+    positive and negative values, so any percentile is returned within a
+    relative error `alpha` regardless of the data range or outliers.
+    Buckets do not depend on the data, so sketches built independently from
+    different chunks merge exactly by adding their counts.
+    '''
+    
+    def __init__(self, alpha=0.005):
+        self.alpha = alpha
+        self.gamma = (1. + alpha) / (1. - alpha)
+        self.zeros = 0
+        self.pos = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        self.neg = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        
+    @property
+    def count(self):
+        return self.zeros + self.pos[1].sum() + self.neg[1].sum()
+        
+    def _buckets(self, x):
+        keys = np.ceil(np.log(x) / np.log(self.gamma)).astype(np.int64)
+        keys, counts = np.unique(keys, return_counts=True)
+        return keys, counts.astype(np.int64)
+        
+    @classmethod
+    def from_array(cls, x, alpha=0.005):
+        '''Sketch of the finite (and unmasked) values of `x` in one pass.'''
+        sketch = cls(alpha)
+        if isinstance(x, np.ma.MaskedArray):
+            # e.g. netCDF4 variables: leave out the fill values
+            x = x.astype(float).filled(np.nan)
+        x = np.asarray(x, dtype=float).ravel()
+        x = x[np.isfinite(x)]
+        tiny = np.finfo(float).tiny
+        sketch.zeros = np.count_nonzero(np.abs(x) < tiny)
+        sketch.pos = sketch._buckets(x[x >= tiny])
+        sketch.neg = sketch._buckets(-x[x <= -tiny])
+        
+        return sketch
+    
+    @staticmethod
+    def _merge_store(a, b):
+        keys = np.concatenate((a[0], b[0]))
+        counts = np.concatenate((a[1], b[1]))
+        keys, inverse = np.unique(keys, return_inverse=True)
+        return keys, np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+    
+    def merge(self, other):
+        '''Add the counts of another sketch to this one.'''
+        self.zeros += other.zeros
+        self.pos = self._merge_store(self.pos, other.pos)
+        self.neg = self._merge_store(self.neg, other.neg)
+        
+        return self
+    
+    def update(self, x):
+        '''Add the values of another chunk of data.'''
+        return self.merge(_QuantileSketch.from_array(x, self.alpha))
+    
+    def percentile(self, q):
+        '''Approximate q-th percentile (0-100).'''
+        n = self.count
+        if n == 0:
+            return np.nan
+        # Bucket values in increasing order: negatives, zero, positives
+        scale = 2. / (1. + self.gamma)
+        values = np.concatenate((-scale * self.gamma**self.neg[0][::-1].astype(float),
+                                 [0.],
+                                 scale * self.gamma**self.pos[0].astype(float)))
+        counts = np.concatenate((self.neg[1][::-1], [self.zeros], self.pos[1]))
+        rank = q / 100. * (n - 1)
+        j = np.searchsorted(np.cumsum(counts), rank, side='right')
+        
+        return values[min(j, len(values) - 1)]
+    
+    
+def _sketch(data, alpha=0.005):
+    '''Quantile sketch of numpy, dask or xarray data, or of an iterable of chunks.'''
+    if hasattr(data, 'dims'):
+        data = data.data   # xarray -> numpy/dask
+    if hasattr(data, 'dask'):
+        import dask
+        parts = [dask.delayed(_QuantileSketch.from_array)(block, alpha)
+                 for block in data.to_delayed().ravel()]
+        parts = dask.compute(*parts)
+    elif hasattr(data, 'shape'):
+        return _QuantileSketch.from_array(data, alpha)
+    else:
+        parts = (_QuantileSketch.from_array(getattr(chunk, 'values', chunk), alpha)
+                 for chunk in data)
+    sketch = _QuantileSketch(alpha)
+    for part in parts:
+        sketch.merge(part)
+        
+    return sketch
+
+
+def nice_intervals(data, nlevs, alpha=0.005):
     '''
     Purpose::
         Calculates nice intervals between each color level for colorbars
         and contour plots. The target minimum and maximum color levels are
         calculated by taking the minimum and maximum of the distribution
         after cutting off the tails to remove outliers.
+        
+        The 5th and 95th percentiles come from a mergeable quantile sketch
+        built in one pass without copying the data. Dask-backed data is
+        sketched chunk by chunk on the workers, so one consistent set of
+        levels can be chosen for a whole animation or batch of maps.
     Input::
-        data - an array of data to be plotted
+        data - an array of data to be plotted (numpy, dask or xarray), or an
+               iterable of such chunks (e.g. the time steps of an animation)
         nlevs - an int giving the target number of intervals
+        alpha - relative accuracy of the percentiles (default 0.5%)
     Output::
         clevs - A list of floats for the resultant colorbar levels
     '''
     # Find the min and max levels by cutting off the tails of the distribution
     # This mitigates the influence of outliers
-    data = data.ravel()
-    mn = mstats.scoreatpercentile(data, 5)
-    mx = mstats.scoreatpercentile(data, 95)
+    sketch = _sketch(data, alpha)
+    mn = sketch.percentile(5)
+    mx = sketch.percentile(95)
     #if there min less than 0 and
     # or max more than 0 
     #put 0 in center of color bar
@@ -226,16 +666,58 @@ def _nice_intervals(data, nlevs):
     return clevs
 
 
-def loadCPT(path):
+# Former private name
+_nice_intervals = nice_intervals
+
+
+# Colormaps loaded by loadCPT, keyed by absolute path
+_CPT_CACHE = {}
+
+# Colormaps registered by loadCPT, by name (may be re-registered)
+_REGISTERED = {}
+
+
+def _register_cmap(cmap, name):
+    '''Register a colormap with matplotlib under `name`, unless a builtin has that name.'''
+    if name in _REGISTERED and _REGISTERED[name] == cmap:
+        return
+    if hasattr(mpl, 'colormaps'):
+        registry = mpl.colormaps
+    else:
+        # matplotlib < 3.5
+        import matplotlib.cm as cm
+        registry = cm.cmap_d
+    if name not in _REGISTERED and name in registry:
+        warnings.warn("colormap {0!r} not registered: matplotlib already has a colormap "
+                      "with that name; pass another name to loadCPT".format(name))
+        return
+    if hasattr(mpl, 'colormaps'):
+        mpl.colormaps.register(cmap, name=name, force=True)
+    else:
+        cm.register_cmap(name=name, cmap=cmap)
+    _REGISTERED[name] = cmap
+
+
+def loadCPT(path, name=None, register=True):
     """A function that loads a .cpt file and converts it into a colormap for the colorbar.
     
     This code was adapted from the GEONETClass Tutorial written by Diego Souza, retrieved 18 July 2019. 
     https://geonetcast.wordpress.com/2017/06/02/geonetclass-manipulating-goes-16-data-with-python-part-v/
     
+    The file is parsed in a single vectorized pass and the colormap is
+    memoized by path and modification time, so repeated calls (e.g. once
+    per frame or per worker task) do not re-read an unchanged file.
+    
     Parameters
     ----------
     path : 
         Path to the .cpt file
+    name : str, optional
+        Colormap name. Default: the file name without extension
+    register : bool, optional
+        Register the colormap with matplotlib under `name`, so it can be
+        used as cmap=name. Names of matplotlib's own colormaps are not
+        registered (with a warning). Default: True
         
     Returns
     -------
@@ -243,77 +725,75 @@ def loadCPT(path):
         A colormap that can be used for the cmap argument in matplotlib type plot.
     """
     
+    path = os.path.abspath(path)
     try:
-        f = open(path)
-    except:
+        mtime = os.path.getmtime(path)
+    except OSError:
         print ("File ", path, "not found")
         return None
- 
-    lines = f.readlines()
- 
-    f.close()
- 
-    x = np.array([])
-    r = np.array([])
-    g = np.array([])
-    b = np.array([])
- 
-    colorModel = 'RGB'
- 
-    for l in lines:
-        ls = l.split()
-        if l[0] == '#':
-            if ls[-1] == 'HSV':
+    if name is None:
+        name = os.path.splitext(os.path.basename(path))[0]
+    
+    cached = _CPT_CACHE.get(path)
+    if cached is not None and cached[0] == mtime and cached[1].name == name:
+        cpt = cached[1]
+    else:
+        with open(path) as f:
+            lines = f.read().splitlines()
+        
+        colorModel = 'RGB'
+        for l in lines:
+            ls = l.split()
+            if l[:1] == '#' and ls and ls[-1].lstrip('+') == 'HSV':
                 colorModel = 'HSV'
-                continue
-            else:
-                continue
-        if ls[0] == 'B' or ls[0] == 'F' or ls[0] == 'N':
-            pass
-        else:
-            x=np.append(x,float(ls[0]))
-            r=np.append(r,float(ls[1]))
-            g=np.append(g,float(ls[2]))
-            b=np.append(b,float(ls[3]))
-            xtemp = float(ls[4])
-            rtemp = float(ls[5])
-            gtemp = float(ls[6])
-            btemp = float(ls[7])
- 
-        x=np.append(x,xtemp)
-        r=np.append(r,rtemp)
-        g=np.append(g,gtemp)
-        b=np.append(b,btemp)
- 
-    if colorModel == 'HSV':
-        for i in range(r.shape[0]):
-            rr, gg, bb = colorsys.hsv_to_rgb(r[i]/360.,g[i],b[i])
-        r[i] = rr ; g[i] = gg ; b[i] = bb
- 
-    if colorModel == 'RGB':
-        r = r/255.0
-        g = g/255.0
-        b = b/255.0
- 
-    xNorm = (x - x[0])/(x[-1] - x[0])
- 
-    red   = []
-    blue  = []
-    green = []
- 
-    for i in range(len(x)):
-        red.append([xNorm[i],r[i],r[i]])
-        green.append([xNorm[i],g[i],g[i]])
-        blue.append([xNorm[i],b[i],b[i]])
- 
-    colorDict = {'red': red, 'green': green, 'blue': blue}
-    # Makes a linear interpolation
-    cpt = LinearSegmentedColormap('cpt', colorDict)
-    
-    return cpt
-
-
-def make_cmap(colors, position=None, bit=False):
+        
+        # Color segments "x1 r1 g1 b1 x2 r2 g2 b2"; skip comments and the
+        # background/foreground/NaN colors (B, F, N)
+        segs = [l for l in lines if l.strip() and l.split()[0][0] not in '#BFN']
+        segs = np.loadtxt(segs, usecols=range(8), ndmin=2)
+        # Start and end point of each segment, in order
+        x, r, g, b = segs.reshape(-1, 2, 4).reshape(-1, 4).T
+        
+        if colorModel == 'HSV':
+            rgb = mpl.colors.hsv_to_rgb(np.stack([r/360., g, b], axis=-1))
+            r, g, b = rgb.T
+     
+        if colorModel == 'RGB':
+            r = r/255.0
+            g = g/255.0
+            b = b/255.0
+     
+        xNorm = (x - x[0])/(x[-1] - x[0])
+     
+        colorDict = {'red': np.stack([xNorm, r, r], axis=-1),
+                     'green': np.stack([xNorm, g, g], axis=-1),
+                     'blue': np.stack([xNorm, b, b], axis=-1)}
+        # Makes a linear interpolation
+        cpt = LinearSegmentedColormap(name, colorDict)
+        _CPT_CACHE[path] = (mtime, cpt)
+    
+    if register:
+        _register_cmap(cpt, name)
+    
+    # Copy, so that set_over/set_under etc. do not change the cached colormap
+    return cpt.copy()
+
+
+@functools.lru_cache(maxsize=128)
+def _make_cmap(colors, position, bit, name):
+    '''Memoized body of make_cmap (arguments are tuples).'''
+    colors = np.array(colors, dtype=float)
+    if bit:
+        colors = colors / 255.
+    position = np.asarray(position, dtype=float)
+    cdict = {'red': np.stack([position, colors[:, 0], colors[:, 0]], axis=-1),
+             'green': np.stack([position, colors[:, 1], colors[:, 1]], axis=-1),
+             'blue': np.stack([position, colors[:, 2], colors[:, 2]], axis=-1)}
+    
+    return LinearSegmentedColormap(name, cdict, 256)
+
+
+def make_cmap(colors, position=None, bit=False, name='my_colormap'):
     '''
     make_cmap takes a list of tuples which contain RGB values. The RGB
     values may either be in 8-bit [0 to 255] (in which bit must be set to
@@ -322,32 +802,29 @@ def make_cmap(colors, position=None, bit=False):
     Arrange your tuples so that the first color is the lowest value for the
     colorbar and the last is the highest.
     position contains values from 0 to 1 to dictate the location of each color.
+    Colormaps are memoized, so repeated calls with the same colors are cheap;
+    each call returns its own copy.
     '''
-    bit_rgb = np.linspace(0,1,256)
-    if position == None:
+    if position is None:
         position = np.linspace(0,1,len(colors))
     else:
         if len(position) != len(colors):
             sys.exit("position length must be the same as colors")
         elif position[0] != 0 or position[-1] != 1:
             sys.exit("position must start with 0 and end with 1")
-    if bit:
-        for i in range(len(colors)):
-            colors[i] = (bit_rgb[colors[i][0]],
-                         bit_rgb[colors[i][1]],
-                         bit_rgb[colors[i][2]])
-    cdict = {'red':[], 'green':[], 'blue':[]}
-    for pos, color in zip(position, colors):
-        cdict['red'].append((pos, color[0], color[0]))
-        cdict['green'].append((pos, color[1], color[1]))
-        cdict['blue'].append((pos, color[2], color[2]))
-
-    cmap = LinearSegmentedColormap('my_colormap',cdict,256)
-    return cmap
+    colors = tuple(tuple(float(c) for c in color[0:3]) for color in colors)
+    position = tuple(float(p) for p in position)
+    
+    return _make_cmap(colors, position, bool(bit), name).copy()
 
 
 def _drawmap(fig, lons, lats, VO, cmap, clevs, title):
     '''Draw contour map for create_animation.'''
+    import matplotlib.ticker as mticker
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
+    from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+
     # Set global extent on map
     ext = [-180.0, 180.0, -90., 90.]
     
@@ -379,24 +856,68 @@ def _drawmap(fig, lons, lats, VO, cmap, clevs, title):
     cs = ax.contourf(lons, lats, VO, transform=datacrs, cmap=cmap, levels=clevs, zorder=1)
     return cs
     
-def _myanimate(i, fig, DS, var, lats, lons, cmap, clevs):
-    '''Loop through time steps for create_animation.'''
-    # Clear current axis to overplot next time step
-    ax = fig.gca()
-    ax.clear()
-    # Loop through time steps in ds
-    VO = DS[var].values[i]
-    # Set title based on long name and current time step
-    ts = pd.to_datetime(str(DS.time.values[i])).strftime("%Y-%m-%d %H:%M")
-    long_name = DS[var].long_name
-    title = '{0} at {1}'.format(long_name, ts)
-    # Add next contour map
-    new_contour = _drawmap(fig, lons, lats, VO, cmap, clevs, title) 
-    return new_contour
-
-def create_animation(DS, lats, lons, var, clevs, cmap, filetype=".mp4"):
+def _frame_title(long_name, time):
+    '''Title of the create_animation frame at `time`.'''
+    import pandas as pd
+
+    ts = pd.to_datetime(str(time)).strftime("%Y-%m-%d %H:%M")
+    return '{0} at {1}'.format(long_name, ts)
+
+
+def _frame_figure(lons, lats, VO, cmap, clevs, title, units, figsize=(12, 4)):
+    '''Figure of the first create_animation frame: map, contours and colorbar.
+    
+    Every frame path (serial, blit and parallel) starts from this figure
+    and only swaps the contours and title (see _myanimate), so their
+    frames have the same layout. Returns the figure, map axes and contours.
+    '''
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=figsize)
+    cs = _drawmap(fig, lons, lats, VO, cmap, clevs, title)
+    cbar = fig.colorbar(cs, orientation='vertical', cmap=cmap, shrink=0.55)
+    cbar.set_label(units, fontsize=12)
+    
+    return fig, fig.axes[0], cs
+
+
+def _myanimate(ax, cs, lons, lats, VO, cmap, clevs, title):
+    '''Replace the contours `cs` and the title of a frame; returns the new contours.'''
+    import cartopy.crs as ccrs
+
+    for a in _contour_artists(cs):
+        a.remove()
+    ax.set_title(title, fontsize=14)
+    return ax.contourf(lons, lats, VO, transform=ccrs.PlateCarree(), cmap=cmap, levels=clevs,
+                       zorder=1)
+
+
+def _serial_frames(DS, var, lats, lons, cmap, clevs, figsize=(12, 4)):
+    '''Yield the frames of create_animation as RGBA arrays, redrawing the whole figure.'''
+    import matplotlib.pyplot as plt
+
+    da = DS[var]
+    times = DS.time.values
+    fig, ax, cs = _frame_figure(lons, lats, da[0].values, cmap, clevs,
+                                _frame_title(da.long_name, times[0]), da.units, figsize)
+    try:
+        for i in range(len(da)):
+            cs = _myanimate(ax, cs, lons, lats, da[i].values, cmap, clevs,
+                            _frame_title(da.long_name, times[i]))
+            fig.canvas.draw()
+            yield np.asarray(fig.canvas.buffer_rgba())
+    finally:
+        plt.close(fig)
+
+
+def create_animation(DS, lats, lons, var, clevs, cmap, filetype=".mp4", nproc=None, blit=False,
+                     progress=None, filename=None, fps=20, codec=None, crf=None):
     '''Create an mp4 animation using an xarray dataset with lat, lon, and time dimensions.
     
+    Frames are drawn on the canvas and streamed as raw RGBA buffers (PNG
+    when rendering in parallel) to an ffmpeg process through a bounded
+    queue, so rendering and encoding run at the same time (see VideoEncoder).
+    
         Parameters
         ----------
         DS: xarray dataset object
@@ -411,42 +932,552 @@ def create_animation(DS, lats, lons, var, clevs, cmap, filetype=".mp4"):
             Contour levels to plot
         cmap: string
             Colormap for plotting
+        nproc: int, optional
+            Number of worker processes. If given, frames are rendered in
+            parallel and piped to ffmpeg in order (see _render_parallel).
+            Default: None (render serially)
+        blit: bool, optional
+            Draw the basemap, gridlines and colorbar once and only redraw the
+            contours and title for each frame (see _blit_frames).
+            Default: False
+        progress: callable, optional
+            Called as progress(nframes_done, nframes_total, frames_per_second)
+            after each frame.
+        filename: string, optional
+            Output path. Default: '<var>_<first time>-<last time><filetype>'
+            (e.g. z_2020010100-2020013118.mp4)
+        fps: int, optional
+            Frames per second. Default: 20
+        codec: string, optional
+            ffmpeg video codec (e.g. 'libx264', 'libx265', 'libvpx-vp9').
+            Default: rcParams['animation.codec']
+        crf: int, optional
+            Constant rate factor of the codec (lower is better quality).
+            Default: None (codec default)
             
         Returns
         -------
         filename, mp4 file of animation
         
         '''
+    import pandas as pd
     
     # Get information from ds
-    long_name = DS[var].long_name
-    units = DS[var].units
-    t0 = pd.to_datetime(str(DS.time.values[0])).strftime("%Y-%m-%d %H:%M")
-    title = '{0} at {1}'.format(long_name, t0)
-    FFMpegWriter = animation.writers['ffmpeg']
-    metadata = dict(title=title,
-                    comment='')
-    writer = FFMpegWriter(fps=20, metadata=metadata)
-    
-    # Create a new figure window
-    fig = plt.figure(figsize=[12,4])
-    # Draw first timestep
-    first_contour = _drawmap(fig, lons, lats, DS[var].values[0], cmap, clevs, title)
-
-    # Add a color bar
-    cbar = fig.colorbar(first_contour, orientation='vertical', cmap=cmap, shrink=0.55)
-    cbar.set_label(units, fontsize=12)
+    times = pd.to_datetime(DS.time.values)
+    title = _frame_title(DS[var].long_name, times[0])
+    if filename is None:
+        filename = '{0}_{1:%Y%m%d%H}-{2:%Y%m%d%H}{3}'.format(var, times[0], times[-1], filetype)
+    encoder_kwargs = dict(fps=fps, codec=codec, crf=crf,
+                          metadata=dict(title=title, comment=''))
+    
+    if nproc is not None:
+        _render_parallel(DS, lats, lons, var, clevs, cmap, filename,
+                         nproc=nproc, progress=progress, **encoder_kwargs)
+        return filename
+    
+    if blit:
+        frames = _blit_frames(DS, var, lats, lons, cmap, clevs)
+        encode_video(frames, filename, nframes=len(DS[var]), progress=progress,
+                     **encoder_kwargs)
+        return filename
     
-    # Loop through animation
-    ani = animation.FuncAnimation(fig, _myanimate, frames=np.arange(len(DS[var])),
-                                  fargs=(fig, DS, var, lats, lons, cmap, clevs), interval=50)
-    filename = long_name + filetype
-    ani.save(filename)
+    # Redraw the figure for each time step, streaming each canvas to ffmpeg
+    frames = _serial_frames(DS, var, lats, lons, cmap, clevs)
+    encode_video(frames, filename, nframes=len(DS[var]), progress=progress, **encoder_kwargs)
     
     return filename
 
 
-def draw_basemap(ax, extent=None, xticks=None, yticks=None, grid=False):
+def _ffmpeg_cmd(filename, fps, input_args, metadata=None, codec=None, crf=None):
+    '''ffmpeg command reading frames from stdin, encoded like matplotlib's FFMpegWriter.'''
+    codec = codec or mpl.rcParams['animation.codec']
+    cmd = [mpl.rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error'] + list(input_args)
+    cmd += ['-r', str(fps), '-i', 'pipe:',
+            '-vcodec', codec, '-pix_fmt', 'yuv420p',
+            # yuv420p needs an even frame width and height
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+    if crf is not None:
+        cmd += ['-crf', str(crf)]
+    for key, value in (metadata or {}).items():
+        cmd += ['-metadata', '{0}={1}'.format(key, value)]
+    cmd += [filename]
+    
+    return cmd
+
+
+class VideoEncoder(object):
+    """Encode video frames with an ffmpeg subprocess.
+    
+    Frames passed to `write` are copied into a bounded queue and written
+    to the stdin of ffmpeg by a background thread, so the next frame can be
+    rendered while the previous ones are encoded. When the queue is full,
+    `write` blocks until the encoder catches up.
+    
+    Frames are either RGBA arrays [height x width x 4] (e.g.
+    np.asarray(fig.canvas.buffer_rgba())), streamed as raw video, or
+    PNG-encoded bytes. The ffmpeg process is started on the first frame.
+    
+    Parameters
+    ----------
+    filename : str
+        Output path; the container follows the extension (.mp4, .mkv, ...)
+    fps : int, optional
+        Frames per second. Default: 20
+    codec : str, optional
+        ffmpeg video codec. Default: rcParams['animation.codec']
+    crf : int, optional
+        Constant rate factor of the codec. Default: None (codec default)
+    metadata : dict, optional
+        Metadata of the output file (e.g. title, comment)
+    maxsize : int, optional
+        Number of frames buffered between render and encode. Default: 8
+        
+    Attributes
+    ----------
+    cmd : list of str
+        ffmpeg command line (None before the first frame)
+    
+    Example
+    -------
+    with VideoEncoder('out.mp4', fps=10, codec='libx264', crf=23) as enc:
+        for i in range(n):
+            draw(fig, i)
+            fig.canvas.draw()
+            enc.write(np.asarray(fig.canvas.buffer_rgba()))
+    print(enc.stats)
+    
+    """
+    def __init__(self, filename, fps=20, codec=None, crf=None, metadata=None, maxsize=8):
+        self.filename = filename
+        self.fps = fps
+        self.codec = codec
+        self.crf = crf
+        self.metadata = metadata
+        self.cmd = None
+        self.stats = None
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._proc = None
+        self._thread = None
+        self._error = None
+        self._frames = 0
+        self._blocked = 0.
+        self._t0 = time.time()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+        
+    def _start(self, frame):
+        if isinstance(frame, np.ndarray):
+            height, width = frame.shape[0:2]
+            input_args = ['-f', 'rawvideo', '-pix_fmt', 'rgba',
+                          '-s', '{0}x{1}'.format(width, height)]
+        else:
+            input_args = ['-f', 'image2pipe', '-vcodec', 'png']
+        self.cmd = _ffmpeg_cmd(self.filename, self.fps, input_args, self.metadata,
+                               codec=self.codec, crf=self.crf)
+        self._proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self._thread = threading.Thread(target=self._encode, daemon=True)
+        self._thread.start()
+        
+    def _encode(self):
+        # Keep draining the queue after an error so write() never blocks
+        while True:
+            buf = self._queue.get()
+            if buf is None:
+                break
+            if self._error is None:
+                try:
+                    self._proc.stdin.write(buf)
+                except OSError as err:
+                    self._error = err
+                    
+    def write(self, frame):
+        """Queue one frame (RGBA array or PNG bytes) for encoding"""
+        if self._error is not None:
+            self._abort()
+            raise self._failure()
+        if self._proc is None:
+            self._start(frame)
+        # Copy: canvas buffers are overwritten by the next draw
+        buf = frame.tobytes() if isinstance(frame, np.ndarray) else bytes(frame)
+        t0 = time.time()
+        self._queue.put(buf)
+        self._blocked += time.time() - t0
+        self._frames += 1
+        
+    def _failure(self):
+        """Exception describing why ffmpeg failed"""
+        returncode = self._proc.poll()
+        stderr = self._proc.stderr.read() if returncode is not None else None
+        if returncode:
+            return subprocess.CalledProcessError(returncode, self.cmd, stderr=stderr)
+        return self._error
+        
+    def _abort(self):
+        if self._proc is None or self._proc.returncode is not None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._proc.kill()
+        self._proc.wait()
+        
+    def close(self):
+        """Wait for the queued frames to be encoded and ffmpeg to finish.
+        
+        Returns
+        -------
+        stats : dict
+            number of frames, elapsed seconds, frames per second and the
+            seconds the producer was blocked on a full queue (encode bound)
+        """
+        if self._proc is not None:
+            self._queue.put(None)
+            self._thread.join()
+            try:
+                self._proc.stdin.close()
+            except OSError:
+                pass
+            stderr = self._proc.stderr.read()
+            returncode = self._proc.wait()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, self.cmd, stderr=stderr)
+            if self._error is not None:
+                raise self._error
+        elapsed = time.time() - self._t0
+        self.stats = {'frames': self._frames, 'seconds': elapsed,
+                      'fps': self._frames / elapsed, 'blocked': self._blocked}
+        
+        return self.stats
+    
+    
+def encode_video(frames, filename, fps=20, codec=None, crf=None, metadata=None,
+                 maxsize=8, nframes=None, progress=None):
+    '''Encode an iterable of frames to a video file with VideoEncoder.
+    
+        Parameters
+        ----------
+        frames: iterable
+            RGBA arrays [height x width x 4] or PNG-encoded bytes, in order
+        filename: string
+            Output path
+        fps, codec, crf, metadata, maxsize: optional
+            See VideoEncoder
+        nframes: int, optional
+            Total number of frames, passed to progress
+        progress: callable, optional
+            Called as progress(nframes_done, nframes_total, frames_per_second)
+            after each frame.
+            
+        Returns
+        -------
+        stats: dict
+            number of frames, elapsed seconds, frames per second and the
+            seconds spent waiting on the encoder
+        '''
+    t0 = time.time()
+    with VideoEncoder(filename, fps=fps, codec=codec, crf=crf, metadata=metadata,
+                      maxsize=maxsize) as encoder:
+        for done, frame in enumerate(frames, 1):
+            encoder.write(frame)
+            if progress is not None:
+                progress(done, nframes, done / (time.time() - t0))
+    
+    return encoder.stats
+
+
+def _contour_artists(cs):
+    '''Artists of a ContourSet (a single artist in matplotlib >= 3.8).'''
+    if isinstance(cs, mpl.artist.Artist):
+        return [cs]
+    return cs.collections
+
+
+def _blit_frames(DS, var, lats, lons, cmap, clevs, figsize=(12, 4)):
+    '''Yield the frames of create_animation as RGBA arrays using cached raster layers.
+    
+    The figure (colorbar, axes, everything below the contours) is drawn
+    once and saved as a raster background, and the features drawn above
+    the contours (coastlines, borders, gridlines and their labels, the map
+    frame) are
+    rasterized once into a transparent overlay. For each time step only the
+    contour artist and the title text are rendered; the overlay is blended
+    over the pixels it covers.
+    
+    Per frame this leaves the contouring and rasterization of the field,
+    which dominate the cost. For a 1 deg global field frames render about
+    3x faster than with a full redraw (about 2.5x end to end with encoding),
+    short of a 10x speedup (see benchmarks/animation_benchmark.py).
+    '''
+    import matplotlib.pyplot as plt
+    import cartopy.crs as ccrs
+
+    da = DS[var]
+    times = DS.time.values
+    
+    # Draw the full first frame to build the static figure
+    fig, ax, cs = _frame_figure(lons, lats, da[0].values, cmap, clevs,
+                                _frame_title(da.long_name, times[0]), da.units, figsize)
+    
+    # Artists redrawn every frame: title and anything above the contours
+    # (coastlines, borders, gridlines, the map frame); the rest goes into
+    # the background
+    cs_artists = _contour_artists(cs)
+    static = set(cs_artists) | {ax.patch, ax.xaxis, ax.yaxis}
+    zorder = cs_artists[0].get_zorder()
+    overlays = [a for a in ax.get_children()
+                if a not in static and not isinstance(a, mpl.text.Text)
+                and a.get_zorder() > zorder]
+    title = ax.title
+    for a in overlays + [title]:
+        a.set_animated(True)
+    for a in cs_artists:
+        a.remove()
+    
+    canvas = fig.canvas
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    
+    # Rasterize the overlays once on a transparent canvas; keep only the
+    # pixels they cover, premultiplied for blending (straight-alpha buffer)
+    canvas.get_renderer().clear()
+    for a in overlays:
+        ax.draw_artist(a)
+    layer = np.asarray(canvas.buffer_rgba())
+    covered = np.flatnonzero(layer[..., 3])
+    layer = layer.reshape(-1, 4)[covered]
+    alpha = layer[:, 3:].astype(np.float32) / 255.
+    layer = layer[:, :3] * alpha
+    alpha = 1. - alpha
+    datacrs = ccrs.PlateCarree()
+    
+    try:
+        for i in range(len(da)):
+            canvas.restore_region(background)
+            cs = ax.contourf(lons, lats, da[i].values, transform=datacrs,
+                             cmap=cmap, levels=clevs, zorder=1)
+            for a in _contour_artists(cs):
+                ax.draw_artist(a)
+            frame = np.asarray(canvas.buffer_rgba())
+            pixels = frame.reshape(-1, 4)
+            pixels[covered, :3] = pixels[covered, :3] * alpha + layer + 0.5
+            title.set_text(_frame_title(da.long_name, times[i]))
+            ax.draw_artist(title)
+            yield frame
+            for a in _contour_artists(cs):
+                a.remove()
+    finally:
+        plt.close(fig)
+
+
+def _init_render_worker():
+    '''Use a non-interactive backend in render worker processes.'''
+    import matplotlib.pyplot as plt
+
+    plt.switch_backend('Agg')
+    
+
+def _render_frames(args):
+    '''Render a block of time steps to PNG buffers for _render_parallel.'''
+    import matplotlib.pyplot as plt
+
+    VO, times, lats, lons, long_name, units, cmap, clevs, figsize = args
+    fig, ax, cs = _frame_figure(lons, lats, VO[0], cmap, clevs,
+                                _frame_title(long_name, times[0]), units, figsize)
+    frames = []
+    for i in range(len(VO)):
+        cs = _myanimate(ax, cs, lons, lats, VO[i], cmap, clevs,
+                        _frame_title(long_name, times[i]))
+        # Same frame size as the FFMpegWriter (figure size at figure dpi)
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=fig.dpi)
+        frames.append(buf.getvalue())
+    plt.close(fig)
+    
+    return frames
+
+
+def _bounded_map(pool, func, tasks, window):
+    '''Like pool.map, but with at most `window` tasks submitted at a time.
+    
+    Executor.map consumes the whole task iterator up front; this reads the
+    next task only when a result is taken, so task inputs (e.g. blocks of
+    frames loaded from disk) and pending results stay bounded. Results are
+    yielded in task order.
+    '''
+    from collections import deque
+    
+    tasks = iter(tasks)
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.submit(func, task))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _render_parallel(DS, lats, lons, var, clevs, cmap, filename, nproc=None,
+                     fps=20, metadata=None, figsize=(12, 4), progress=None,
+                     codec=None, crf=None):
+    '''Render the frames of create_animation in a process pool.
+    
+    The time axis is split into blocks that are rendered independently to
+    PNG buffers by the workers and streamed, in time order, into a single
+    ffmpeg process (see encode_video). Only about 2*nproc blocks are loaded
+    or rendered ahead of the encoder at any time.
+    
+    Returns
+    -------
+    stats : dict
+        number of frames, elapsed seconds and frames per second
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    
+    da = DS[var]
+    long_name = da.long_name
+    units = da.units
+    times = DS.time.values
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    nframes = len(da)
+    nproc = nproc or os.cpu_count()
+    blocksize = max(1, min(25, nframes // (4 * nproc)))
+    
+    def blocks():
+        for i in range(0, nframes, blocksize):
+            yield (da[i:i+blocksize].values, times[i:i+blocksize], lats, lons,
+                   long_name, units, cmap, clevs, figsize)
+    
+    with ProcessPoolExecutor(max_workers=nproc, initializer=_init_render_worker) as pool:
+        results = _bounded_map(pool, _render_frames, blocks(), 2 * nproc)
+        frames = (frame for block in results for frame in block)
+        stats = encode_video(frames, filename, fps=fps, codec=codec, crf=crf,
+                             metadata=metadata, nframes=nframes, progress=progress)
+    
+    return stats
+
+
+class FeatureCache(object):
+    """In-memory LRU (and optional on-disk) cache of projected map features
+    
+    Stores the Natural Earth geometries of a feature that intersect the
+    map extent, already projected to the map projection, keyed by
+    (feature, scale, projection, extent). Panels and later runs that use the
+    same map then skip reading the shapefile and re-projecting it. Other
+    features (e.g. ShapelyFeature) are added without caching.
+    
+    Parameters
+    ----------
+    maxsize : int, optional
+        number of (feature, scale, projection, extent) entries kept in
+        memory. Default: 64
+    cache_dir : str, optional
+        directory for a persistent copy of each entry. Default: None
+        (memory only)
+        
+    Example
+    -------
+    feature_cache.cache_dir = os.path.expanduser('~/.cache/pyclivac')
+    for ax in axs.flat:
+        draw_basemap(ax, extent=[-170, -10, -60, 20])
+    print(feature_cache.info())
+    """
+    
+    def __init__(self, maxsize=64, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._geoms = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        
+    def geometries(self, feature, ax):
+        """Geometries of `feature` in the projection and extent of `ax`"""
+        import cartopy.feature as cfeature
+
+        projection = ax.projection
+        x0, x1, y0, y1 = ax.get_extent()
+        scale = feature.scale
+        if hasattr(feature, 'scaler'):
+            scale = feature.scaler.scale_from_extent(ax.get_extent(feature.crs))
+        key = (feature.category, feature.name, scale, projection.proj4_init,
+               tuple(np.round([x0, x1, y0, y1], 6)))
+        
+        if key in self._geoms:
+            self.hits += 1
+            self._geoms.move_to_end(key)
+            return self._geoms[key]
+        
+        path = None
+        if self.cache_dir is not None:
+            name = hashlib.sha1(repr(key).encode()).hexdigest() + '.pkl'
+            path = os.path.join(self.cache_dir, name)
+        
+        if path is not None and os.path.exists(path):
+            self.disk_hits += 1
+            with open(path, 'rb') as f:
+                geoms = pickle.load(f)
+        else:
+            self.misses += 1
+            # Same selection and projection as cartopy's FeatureArtist:
+            # only the geometries within the extent are projected
+            src = cfeature.NaturalEarthFeature(feature.category, feature.name, scale)
+            geoms = []
+            for geom in src.intersecting_geometries(ax.get_extent(src.crs)):
+                geom = projection.project_geometry(geom, src.crs)
+                if not geom.is_empty:
+                    geoms.append(geom)
+            if path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(path + '.tmp', 'wb') as f:
+                    pickle.dump(geoms, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + '.tmp', path)
+        
+        self._geoms[key] = geoms
+        if len(self._geoms) > self.maxsize:
+            self._geoms.popitem(last=False)
+            
+        return geoms
+    
+    def add_feature(self, ax, feature, **kwargs):
+        """Cached equivalent of ax.add_feature(feature, **kwargs)"""
+        import cartopy.feature as cfeature
+
+        if not isinstance(feature, cfeature.NaturalEarthFeature):
+            return ax.add_feature(feature, **kwargs)
+        geoms = self.geometries(feature, ax)
+        style = dict(feature.kwargs, **kwargs)
+        
+        return ax.add_geometries(geoms, crs=ax.projection, **style)
+    
+    def info(self):
+        """Hit/miss statistics"""
+        return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses, 'size': len(self._geoms),
+                'maxsize': self.maxsize}
+    
+    def clear(self):
+        """Empty the in-memory cache and reset the statistics"""
+        self._geoms.clear()
+        self.hits = self.disk_hits = self.misses = 0
+        
+
+# Shared by draw_basemap
+feature_cache = FeatureCache()
+
+
+def draw_basemap(ax, extent=None, xticks=None, yticks=None, grid=False, cache=feature_cache):
     """
     Draws a basemap on which to plot data. 
     
@@ -471,6 +1502,10 @@ def draw_basemap(ax, extent=None, xticks=None, yticks=None, grid=False):
     yticks : float
         array of ytick locations (latitude tick marks)
         
+    cache : FeatureCache
+        cache of projected map features; None adds the cartopy features
+        directly. Default: feature_cache (shared by all calls)
+        
     Returns
     -------
     ax :
@@ -486,6 +1521,9 @@ def draw_basemap(ax, extent=None, xticks=None, yticks=None, grid=False):
     Tessa Montini, tmontini@ucsb.edu
     
     """
+    import cartopy.feature as cfeature
+    from cartopy.mpl.ticker import LongitudeFormatter, LatitudeFormatter
+
 
     # Use map projection (CRS) of the given Axes
     mapcrs = ax.projection    
@@ -499,9 +1537,13 @@ def draw_basemap(ax, extent=None, xticks=None, yticks=None, grid=False):
         ax.set_extent(extent, crs=mapcrs)
     
     # Add map features (continents and country borders)
-    ax.add_feature(cfeature.LAND, facecolor='0.9')      
-    ax.add_feature(cfeature.BORDERS, edgecolor='0.4', linewidth=0.8)
-    ax.add_feature(cfeature.COASTLINE, edgecolor='0.4', linewidth=0.8)
+    if cache is None:
+        add_feature = ax.add_feature
+    else:
+        add_feature = lambda feature, **kwargs: cache.add_feature(ax, feature, **kwargs)
+    add_feature(cfeature.LAND, facecolor='0.9')      
+    add_feature(cfeature.BORDERS, edgecolor='0.4', linewidth=0.8)
+    add_feature(cfeature.COASTLINE, edgecolor='0.4', linewidth=0.8)
 
     ## Tickmarks/Labels
     # Set xticks if requested
@@ -526,4 +1568,155 @@ def draw_basemap(ax, extent=None, xticks=None, yticks=None, grid=False):
     if (grid == True):
         ax.grid(color='k', alpha=0.5, linewidth=0.5, linestyle='--')
     
-    return ax
\ No newline at end of file
+    return ax
+
+def _panel_title(dim, label):
+    '''Default panel title for one label of the stacked dimension.'''
+    if np.issubdtype(np.asarray(label).dtype, np.datetime64):
+        import pandas as pd
+        return pd.Timestamp(label).strftime("%Y-%m-%d %H:%M")
+    if dim == 'mode':
+        return 'EOF {0}'.format(label)
+    if dim is None:
+        return 'Panel {0}'.format(label)
+    return '{0} = {1}'.format(dim, label)
+
+
+def plot_panels(data, lons=None, lats=None, dim=None, ncols=3, kind='contourf',
+                cmap='RdBu_r', levels=None, nlevs=11, titles=None, extent=None,
+                mapcrs=None, datacrs=None, xticks=None, yticks=None, grid=False,
+                cbar_label=None, cbar_orientation='horizontal', panel_size=(4, 3),
+                filename=None, dpi=150, cache=feature_cache):
+    '''Small multiples: plot a stack of 2d fields on a grid of maps in one call.
+    
+    The panels share the map projection and extent, the basemap (whose
+    features are projected once through `cache`), the color levels and
+    normalization, and a single colorbar. Tick labels are only drawn on the
+    outer panels.
+    
+        Parameters
+        ----------
+        data: xarray DataArray or array
+            Fields stacked along `dim`, e.g. the evecs or loadings from
+            eofs.calc_eofs_xarray (dims mode, lat, lon) or monthly composites
+            (dims month, lat, lon). A numpy array [npanels x nlat x nlon]
+            (e.g. evecs from eofs.calc_eofs_svd reshaped to the grid) needs
+            lons and lats.
+        lons, lats: array, optional
+            1d coordinates. Default: the longitude/lon and latitude/lat
+            coordinates of data
+        dim: string, optional
+            Dimension to stack the panels along. Default: first dimension
+        ncols: int, optional
+            Number of panel columns. Default: 3
+        kind: string, optional
+            'contourf' (default) or 'pcolormesh'
+        cmap: string or Colormap, optional
+            Default: 'RdBu_r'
+        levels: array, optional
+            Color levels shared by all panels. Default: nice_intervals of
+            all panels with nlevs intervals (centered on 0 if data has both
+            signs)
+        titles: list of str, optional
+            Panel titles. Default: built from the labels of dim
+            (e.g. 'EOF 1' for dim 'mode', dates for a time dimension,
+            'Panel 1' for an array)
+        extent: list, optional
+            Map extent [lonmin, lonmax, latmin, latmax] (see draw_basemap).
+            Default: bounds of lons and lats for a PlateCarree map, else global
+        mapcrs, datacrs: cartopy CRS, optional
+            Map and data projections. Default: ccrs.PlateCarree()
+        xticks, yticks, grid: optional
+            Passed to draw_basemap
+        cbar_label: string, optional
+            Default: the units attribute of data
+        cbar_orientation: string, optional
+            'horizontal' (default) or 'vertical'
+        panel_size: tuple, optional
+            Size of one panel in inches. Default: (4, 3)
+        filename: string, optional
+            Save the figure to this file at dpi
+        cache: FeatureCache, optional
+            Passed to draw_basemap. Default: feature_cache
+            
+        Returns
+        -------
+        fig, axes:
+            Figure and 2d array of GeoAxes (unused panels are hidden)
+            
+        Example
+        -------
+        evals, evecs, loadings, pcs = eofs.calc_eofs_xarray(z500, neofs=6)
+        fig, axes = plot_panels(loadings, ncols=3, cbar_label='m')
+        '''
+    import matplotlib.pyplot as plt
+    import cartopy.crs as ccrs
+    
+    if mapcrs is None:
+        mapcrs = ccrs.PlateCarree()
+    if datacrs is None:
+        datacrs = ccrs.PlateCarree()
+    
+    # Stacked values [npanels x nlat x nlon] and panel labels
+    if hasattr(data, 'dims'):
+        dim = dim or data.dims[0]
+        data = data.transpose(dim, ...)
+        if lons is None:
+            lons = data['longitude' if 'longitude' in data.coords else 'lon'].values
+        if lats is None:
+            lats = data['latitude' if 'latitude' in data.coords else 'lat'].values
+        labels = data[dim].values if dim in data.coords else np.arange(1, data.shape[0]+1)
+        if cbar_label is None:
+            cbar_label = data.attrs.get('units', '')
+        values = data.values
+    else:
+        values = np.asarray(data)
+        labels = np.arange(1, values.shape[0]+1)
+    npanels = values.shape[0]
+    if titles is None:
+        titles = [_panel_title(dim, label) for label in labels]
+    if extent is None and isinstance(mapcrs, ccrs.PlateCarree):
+        extent = [np.min(lons), np.max(lons), np.min(lats), np.max(lats)]
+    
+    # Shared color levels and normalization
+    cmap = plt.get_cmap(cmap)
+    if levels is None:
+        levels = nice_intervals(values, nlevs)
+    norm = mpl.colors.BoundaryNorm(levels, cmap.N, extend='both')
+    
+    # Panel grid
+    nrows = -(-npanels // ncols)
+    ncols = min(ncols, npanels)
+    fig, axes = plt.subplots(nrows, ncols, squeeze=False,
+                             figsize=(panel_size[0]*ncols, panel_size[1]*nrows),
+                             subplot_kw={'projection': mapcrs})
+    for i, ax in enumerate(axes.flat):
+        if i >= npanels:
+            ax.set_visible(False)
+            continue
+        row, col = divmod(i, ncols)
+        # Only the outer panels get tick labels
+        last_row = (row == nrows-1) or (i + ncols >= npanels)
+        draw_basemap(ax, extent=extent, grid=grid, cache=cache,
+                     xticks=xticks if last_row else None,
+                     yticks=yticks if col == 0 else None)
+        if kind == 'contourf':
+            ax.contourf(lons, lats, values[i], transform=datacrs, cmap=cmap,
+                        levels=levels, norm=norm, extend='both')
+        else:
+            ax.pcolormesh(lons, lats, values[i], transform=datacrs, cmap=cmap,
+                          norm=norm, shading='auto')
+        ax.set_title(titles[i], fontsize=10)
+    
+    # One colorbar for all panels
+    sm = mpl.cm.ScalarMappable(norm=norm, cmap=cmap)
+    cbar = fig.colorbar(sm, ax=[ax for ax in axes.flat if ax.get_visible()],
+                        orientation=cbar_orientation, shrink=0.8, pad=0.05,
+                        ticks=levels, extend='both')
+    cbar.set_label(cbar_label, fontsize=10)
+    cbar.ax.tick_params(labelsize=8)
+    
+    if filename is not None:
+        fig.savefig(filename, dpi=dpi, bbox_inches='tight')
+    
+    return fig, axes